@@ -0,0 +1,33 @@
+import asyncio
+import threading
+
+class AsyncEngine():
+    # Event loop in one background thread for network requests of plugin
+    def __init__(self, logger, name='YandexDevicesAsync'):
+        self.logger = logger
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def submit(self, coro):
+        # returns concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        # sync facade, waits for result in calling thread
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("AsyncEngine.run() can not be called from event loop thread")
+        return self.submit(coro).result(timeout)
+
+    def stop(self, timeout=5):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
@@ -0,0 +1,169 @@
+import asyncio
+import json
+import ssl
+import time
+import aiohttp
+import certifi
+import requests
+from plugins.YandexDevices.RateLimit import backoff_delay, WRITE_RETRY_STATUS
+from plugins.YandexDevices.Metrics import endpoint_name
+
+_NOT_LOADED = object()
+
+class AsyncQuazarApi():
+    # aiohttp client of account, cookies, CSRF, limits, breaker and authorization are shared with QuazarApi
+    def __init__(self, quazar, max_in_flight=200):
+        self.quazar = quazar
+        self.logger = quazar.logger
+        self.metrics = quazar.metrics
+        self.max_in_flight = max_in_flight
+        self._session = None
+        self._semaphore = None
+        self._cookie_mtime = _NOT_LOADED
+        self._cookie_checked = 0
+
+    async def _get_session(self):
+        # created in thread of event loop
+        if self._session is None:
+            ssl_context = ssl.create_default_context(cafile=certifi.where())
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight, ssl=ssl_context)
+            self._session = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.CookieJar(unsafe=True))
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._cookie_mtime = _NOT_LOADED
+        # cookie file is read by QuazarApi out of event loop, not often than once a second
+        now = time.monotonic()
+        if now - self._cookie_checked >= 1:
+            self._cookie_checked = now
+            await asyncio.get_running_loop().run_in_executor(None, self.quazar._load_cookies)
+        # jar is updated only after change
+        if self.quazar._cookie_mtime != self._cookie_mtime:
+            self._session.cookie_jar.clear()
+            self._session.cookie_jar.update_cookies(requests.utils.dict_from_cookiejar(self.quazar.session.cookies))
+            self._cookie_mtime = self.quazar._cookie_mtime
+        return self._session
+
+    async def _acquire(self, bucket, priority):
+        while not bucket.acquire(priority=priority, timeout=0):
+            await asyncio.sleep(max(1 / bucket.rate, 0.01))
+
+    async def api_request(self, url, method='GET', params=None, background=False):
+        # same logic as QuazarApi.api_request
+        quazar = self.quazar
+        if isinstance(params, dict):
+            params = json.dumps(params)
+        bucket = quazar.read_limit if method == 'GET' else quazar.write_limit
+        max_retries = 1 if background else quazar.max_retries
+        attempt = 0
+        repeating = False
+        csrf_token = None
+        endpoint = endpoint_name(url)
+        url = quazar._rewrite(url)
+        session = await self._get_session()
+        while True:
+            if quazar.authorized is False:
+                self.metrics.inc('api_errors_total', endpoint=endpoint, error='skipped_unauthorized')
+                return None
+            if not quazar.breaker.allow(background):
+                self.metrics.inc('api_errors_total', endpoint=endpoint, error='skipped_breaker')
+                return None
+
+            headers = {}
+            if method != 'GET':
+                if not csrf_token:
+                    # получение токена - редкий блокирующий запрос
+                    csrf_token = await asyncio.get_running_loop().run_in_executor(None, quazar.get_csrf)
+                    if not csrf_token:
+                        self.logger.error(f"No CSRF token, request skipped: {method} {url}")
+                        self.metrics.inc('api_errors_total', endpoint=endpoint, error='no_csrf')
+                        return None
+                headers = {
+                    'Content-type': 'application/json',
+                    'x-csrf-token': csrf_token
+                }
+
+            await self._acquire(bucket, not background)
+
+            status = None
+            text = None
+            error = None
+            error_class = None
+            retry_after = None
+            retryable = method == 'GET'
+            quazar._count_request()
+            started = time.monotonic()
+            try:
+                async with self._semaphore:
+                    async with session.request(method, url, data=params, headers=headers,
+                                               timeout=aiohttp.ClientTimeout(total=quazar.timeout)) as response:
+                        status = response.status
+                        text = await response.text()
+                        cookies = {name: morsel.value for name, morsel in response.cookies.items()}
+                        retry_after = response.headers.get('Retry-After')
+                if cookies:
+                    # file write out of event loop
+                    await asyncio.get_running_loop().run_in_executor(None, quazar.merge_cookies, cookies)
+                if status == 429:
+                    error = "Too many requests"
+                    error_class = 'throttled'
+                    try:
+                        retry_after = float(retry_after or 0)
+                    except ValueError:
+                        retry_after = None
+                elif status >= 500:
+                    error = f"Server error {status}"
+                    error_class = 'server'
+                retryable = retryable or status in WRITE_RETRY_STATUS
+            except asyncio.TimeoutError as e:
+                error = f"Request timeout: {e}"
+                error_class = 'timeout'
+            except aiohttp.ClientConnectorError as e:
+                # connection was not established, request was not sent
+                error = f"Request error: {e}"
+                error_class = 'network'
+                retryable = True
+            except aiohttp.ClientError as e:
+                error = f"Request error: {e}"
+                error_class = 'network'
+            self.metrics.observe('api_request_seconds', time.monotonic() - started, endpoint=endpoint, method=method)
+            self.metrics.inc('api_requests_total', endpoint=endpoint, method=method, status=status if status is not None else 'error')
+
+            if error:
+                self.metrics.inc('api_errors_total', endpoint=endpoint, error=error_class)
+                quazar.breaker.failure()
+                if attempt >= max_retries or not retryable:
+                    self.logger.error(f"{error}: {method} {url}")
+                    return None
+                await asyncio.sleep(backoff_delay(attempt, retry_after=retry_after if error_class == 'throttled' else None))
+                attempt += 1
+                continue
+            quazar.breaker.success()
+
+            if status == 401:
+                self.metrics.inc('api_errors_total', endpoint=endpoint, error='unauthorized')
+                if quazar.authorized is not False:
+                    self.logger.error("Unauthorized access, requests stopped until authorization")
+                quazar.set_authorized(False)
+                return None
+            if status < 400:
+                quazar.set_authorized(True)
+            try:
+                data = json.loads(text)
+            except ValueError:
+                data = None
+
+            if not repeating and (data is None or data.get('code') != 'BAD_REQUEST') and (data is None or status == 403 or data.get('status') == 'error'):
+                if status == 403 or quazar._is_csrf_error(data):
+                    self.metrics.inc('api_errors_total', endpoint=endpoint, error='csrf')
+                    quazar.invalidate_csrf(csrf_token)
+                else:
+                    self.metrics.inc('api_errors_total', endpoint=endpoint, error='api_error')
+                csrf_token = None
+                repeating = True
+                continue
+
+            return data
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -0,0 +1,161 @@
+import threading
+from plugins.YandexDevices.models.YaCapabilities import YaCapabilities
+
+class CapabilityState():
+    __slots__ = ('id', 'device_id', 'title', 'value', 'updated', 'read_only',
+                 'linked_object', 'linked_property', 'linked_method', 'dirty', 'push', 'upstream_ts')
+
+    def __init__(self, device_id, title, rec=None):
+        self.id = None
+        self.device_id = device_id
+        self.title = title
+        self.value = None
+        self.updated = None
+        self.read_only = None
+        self.linked_object = None
+        self.linked_property = None
+        self.linked_method = None
+        self.dirty = rec is None  # new record - must be inserted
+        self.push = False  # send value to linked property even if not changed
+        self.upstream_ts = None  # last_updated from yandex
+        if rec is not None:
+            self.id = rec.id
+            self.value = rec.value
+            self.updated = rec.updated
+            self.read_only = rec.read_only
+            self.set_links(rec)
+
+    def set_links(self, rec):
+        self.linked_object = rec.linked_object
+        self.linked_property = rec.linked_property
+        self.linked_method = rec.linked_method
+        self.read_only = rec.read_only
+        self.push = True
+
+    def set_value(self, value, updated):
+        self.value = value
+        self.updated = updated
+        self.dirty = True
+
+class CapabilityCache():
+    def __init__(self):
+        self._devices = {}  # device_id -> {title: CapabilityState}
+        self._lock = threading.Lock()
+
+    def get_device(self, session, device_id):
+        # Capabilities of device, loaded from DB on first access
+        caps = self._devices.get(device_id)
+        if caps is not None:
+            return caps
+        recs = session.query(YaCapabilities).filter(YaCapabilities.device_id == device_id).all()
+        caps = {rec.title: CapabilityState(device_id, rec.title, rec) for rec in recs}
+        with self._lock:
+            return self._devices.setdefault(device_id, caps)
+
+    def get(self, session, device_id, title):
+        caps = self.get_device(session, device_id)
+        state = caps.get(title)
+        if state is None:
+            state = CapabilityState(device_id, title)
+            caps[title] = state
+        return state
+
+    def update_links(self, rec):
+        # links changed from admin
+        caps = self._devices.get(rec.device_id)
+        if caps is not None and rec.title in caps:
+            caps[rec.title].set_links(rec)
+
+    def drop(self, device_id):
+        with self._lock:
+            self._devices.pop(device_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._devices = {}
+
+    def flush(self, session, device_id):
+        # Write changed capabilities of device to session (commit by caller)
+        # Returns written states, pass them to committed() after successful commit
+        caps = self._devices.get(device_id)
+        if not caps:
+            return []
+        new_recs = []
+        updates = []
+        written = []
+        for state in caps.values():
+            if not state.dirty:
+                continue
+            if state.id is None:
+                rec = YaCapabilities(device_id=device_id, title=state.title, value=state.value, updated=state.updated)
+                new_recs.append((state, rec))
+            else:
+                updates.append({'id': state.id, 'value': state.value, 'updated': state.updated})
+                written.append((state, None))
+        if new_recs:
+            session.add_all([rec for _, rec in new_recs])
+            session.flush()
+            written.extend((state, rec.id) for state, rec in new_recs)
+        if updates:
+            session.bulk_update_mappings(YaCapabilities, updates)
+        return written
+
+    def committed(self, written):
+        # states are saved - clear dirty flags and set ids of new records
+        for state, rec_id in written:
+            state.dirty = False
+            if rec_id is not None:
+                state.id = rec_id
+
+def capability_type(title):
+    # devices.capabilities.range.brightness -> devices.capabilities.range
+    if title == 'devices.capabilities.on_off':
+        return title
+    return title.rsplit('.', 1)[0]
+
+class LinkIndex():
+    def __init__(self):
+        self._index = {}  # (object, property) -> {(device_id, title): (iot_id, title, type)}
+        self._keys = {}  # (device_id, title) -> (object, property)
+        self._lock = threading.Lock()
+
+    def load(self, rows):
+        # rows - (device_id, iot_id, title, linked_object, linked_property)
+        with self._lock:
+            self._index = {}
+            self._keys = {}
+            for device_id, iot_id, title, linked_object, linked_property in rows:
+                self._add(device_id, iot_id, title, linked_object, linked_property)
+
+    def set(self, device_id, iot_id, title, linked_object, linked_property):
+        with self._lock:
+            self._remove(device_id, title)
+            if linked_object and linked_property:
+                self._add(device_id, iot_id, title, linked_object, linked_property)
+
+    def get(self, linked_object, linked_property):
+        with self._lock:
+            links = self._index.get((linked_object, linked_property))
+            if not links:
+                return []
+            return list(links.values())
+
+    def drop_device(self, device_id):
+        with self._lock:
+            for key in [key for key in self._keys if key[0] == device_id]:
+                self._remove(*key)
+
+    def _add(self, device_id, iot_id, title, linked_object, linked_property):
+        link = (linked_object, linked_property)
+        self._index.setdefault(link, {})[(device_id, title)] = (iot_id, title, capability_type(title))
+        self._keys[(device_id, title)] = link
+
+    def _remove(self, device_id, title):
+        link = self._keys.pop((device_id, title), None)
+        if link is None:
+            return
+        links = self._index.get(link)
+        if links is not None:
+            links.pop((device_id, title), None)
+            if not links:
+                del self._index[link]
@@ -0,0 +1,45 @@
+import json
+from plugins.YandexDevices.CapabilityCache import capability_type
+
+BOOLEAN_TYPES = ('devices.capabilities.on_off', 'devices.capabilities.toggle')
+NUMERIC_TYPES = ('devices.capabilities.range', 'devices.properties.float', 'devices')
+NUMERIC_TITLES = ('devices.capabilities.color_setting.temperature_k',)
+PRECISION = 3
+UNKNOWN = '?'  # capability without state
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'on', 'yes')
+    return bool(value)
+
+def normalize_value(title, value):
+    # Typed value of capability (from API or stored string)
+    if value is None or value == UNKNOWN:
+        return value  # unknown state is not "off"
+    cap_type = capability_type(title)
+    if cap_type in BOOLEAN_TYPES or isinstance(value, bool):
+        return int(_to_bool(value))
+    if cap_type in NUMERIC_TYPES or title in NUMERIC_TITLES or isinstance(value, (int, float)):
+        try:
+            number = round(float(value), PRECISION)
+        except (TypeError, ValueError):
+            return str(value)
+        return int(number) if number.is_integer() else number
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, ensure_ascii=False)
+    return str(value)
+
+def value_to_str(value):
+    # Value for DB
+    if value is None:
+        return None
+    return str(value)
+
+def is_changed(title, new_value, old_value, deadband=0):
+    if value_to_str(new_value) == value_to_str(old_value):
+        return False
+    if deadband and isinstance(new_value, (int, float)) and isinstance(old_value, (int, float)):
+        # small changes of sensors are ignored
+        if capability_type(title) == 'devices.properties.float' and abs(new_value - old_value) < deadband:
+            return False
+    return True
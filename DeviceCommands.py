@@ -0,0 +1,82 @@
+import json
+import threading
+from collections import OrderedDict
+from plugins.YandexDevices.CapabilityCache import capability_type
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'on', 'yes')
+    return bool(value)
+
+def _to_number(value):
+    value = float(value)
+    if value.is_integer():
+        return int(value)
+    return value
+
+def build_action(title, value):
+    # Action for /devices/{id}/actions by capability title (type + instance)
+    cap_type = capability_type(title)
+    if not cap_type.startswith('devices.capabilities.'):
+        return None  # properties are read only
+    instance = 'on' if cap_type == title else title[len(cap_type) + 1:]
+    kind = cap_type[len('devices.capabilities.'):]
+
+    if kind in ('on_off', 'toggle'):
+        value = _to_bool(value)
+    elif kind == 'range':
+        value = _to_number(value)
+    elif kind == 'color_setting':
+        if instance == 'temperature_k':
+            value = _to_number(value)
+        elif instance in ('hsv', 'rgb') and isinstance(value, str):
+            value = json.loads(value) if value.startswith('{') else _to_number(value)
+        else:
+            value = str(value)  # color/scene id
+    elif kind in ('mode', 'quasar.server_action'):
+        value = str(value)
+
+    return {
+        "type": cap_type,
+        "state": {
+            "instance": instance,
+            "value": value
+        }
+    }
+
+class CommandBatcher():
+    def __init__(self, send, window=0.1):
+        self._send = send  # send(iot_id, actions)
+        self.window = window  # seconds
+        self._pending = {}  # iot_id -> OrderedDict((type, instance) -> action)
+        self._timers = {}
+        self._send_locks = {}
+        self._lock = threading.Lock()
+
+    def add(self, iot_id, action):
+        with self._lock:
+            pending = self._pending.setdefault(iot_id, OrderedDict())
+            key = (action['type'], action['state']['instance'])
+            pending.pop(key, None)  # newer value replaces older
+            pending[key] = action
+            if self.window <= 0 or iot_id in self._timers:
+                timer = None
+            else:
+                timer = threading.Timer(self.window, self.flush, args=(iot_id,))
+                timer.daemon = True
+                self._timers[iot_id] = timer
+        if self.window <= 0:
+            self.flush(iot_id)
+        elif timer:
+            timer.start()
+
+    def flush(self, iot_id):
+        # device commands are sent one by one in order of arrival
+        with self._lock:
+            send_lock = self._send_locks.setdefault(iot_id, threading.Lock())
+        with send_lock:
+            with self._lock:
+                self._timers.pop(iot_id, None)
+                pending = self._pending.pop(iot_id, None)
+            if pending:
+                self._send(iot_id, list(pending.values()))
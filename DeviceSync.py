@@ -0,0 +1,61 @@
+DEVICE_FIELDS = ('title', 'device_type', 'room', 'icon')
+
+def payload_devices(data):
+    # iot_id -> (fields, quasar device_id) from /m/user/devices
+    devices = {}
+    for room in data.get('rooms') or []:
+        for device in room.get('devices') or []:
+            fields = {
+                'title': device.get('name'),
+                'device_type': device.get('type'),
+                'room': room.get('name'),
+                'icon': device.get('icon_url'),
+            }
+            quasar_id = (device.get('quasar_info') or {}).get('device_id')
+            devices[device['id']] = (fields, quasar_id)
+    # устройства без комнаты
+    for device in data.get('unconfigured_devices') or []:
+        if device.get('id') and device['id'] not in devices:
+            fields = {
+                'title': device.get('name'),
+                'device_type': device.get('type'),
+                'room': None,
+                'icon': device.get('icon_url'),
+            }
+            devices[device['id']] = (fields, (device.get('quasar_info') or {}).get('device_id'))
+    return devices
+
+class SyncDiff():
+    def __init__(self):
+        self.added = {}  # iot_id -> fields
+        self.changed = {}  # iot_id -> (record, changed fields)
+        self.removed = []  # records
+
+    def report(self):
+        return {
+            'added': sorted(fields['title'] or iot_id for iot_id, fields in self.added.items()),
+            'changed': sorted(rec.title or rec.iot_id for rec, _ in self.changed.values()),
+            'removed': sorted(rec.title or rec.iot_id or str(rec.id) for rec in self.removed),
+        }
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+def diff_devices(records, devices):
+    # records - YaDevices from DB, devices - result of payload_devices
+    diff = SyncDiff()
+    existing = {}
+    for rec in records:
+        if rec.iot_id in devices and rec.iot_id not in existing:
+            existing[rec.iot_id] = rec
+        else:
+            diff.removed.append(rec)  # нет в аккаунте или дубликат
+    for iot_id, (fields, _) in devices.items():
+        rec = existing.get(iot_id)
+        if rec is None:
+            diff.added[iot_id] = fields
+            continue
+        changed = {name: value for name, value in fields.items() if getattr(rec, name) != value}
+        if changed:
+            diff.changed[iot_id] = (rec, changed)
+    return diff
@@ -0,0 +1,179 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+RAW = struct.Struct('<dd')  # timestamp, value
+AGG = struct.Struct('<ddddd')  # bucket timestamp, min, max, sum, count
+
+class HistoryStore():
+    # Append-only history of capability values, one raw and one aggregated file per capability
+    def __init__(self, path, raw_retention=7 * 86400, agg_retention=365 * 86400, bucket=300):
+        self.path = path
+        self.raw_retention = raw_retention
+        self.agg_retention = agg_retention
+        self.bucket = bucket  # seconds in aggregated record
+        self._files = {}  # str(cap_id) -> append file of raw data
+        self._last = {}  # cap_id -> last timestamp
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _raw_path(self, cap_id):
+        return os.path.join(self.path, f'{cap_id}.raw')
+
+    def _agg_path(self, cap_id):
+        return os.path.join(self.path, f'{cap_id}.agg')
+
+    def append(self, cap_id, value, ts=None):
+        ts = time.time() if ts is None else ts
+        cap_id = str(cap_id)  # same keys as names of files
+        with self._lock:
+            last = self._last.get(cap_id)
+            if last is None:
+                last = self._read_last(cap_id)
+            if last is not None and ts <= last:
+                return False  # only increasing timestamps
+            f = self._files.get(cap_id)
+            if f is None:
+                f = open(self._raw_path(cap_id), 'ab')
+                self._files[cap_id] = f
+            f.write(RAW.pack(ts, value))
+            f.flush()
+            self._last[cap_id] = ts
+            return True
+
+    def query(self, cap_id, start, end, points=500):
+        # List of [timestamp, min, max, avg], downsampled to about points buckets
+        step = max((end - start) / points, 0) if points else 0
+        with self._lock:
+            agg = self._read_range(self._agg_path(cap_id), AGG, start, end)
+            raw = self._read_range(self._raw_path(cap_id), RAW, start, end)
+        if agg:
+            # aggregated data only before raw data
+            first_raw = raw[0][0] if raw else float('inf')
+            agg = [rec for rec in agg if rec[0] + self.bucket <= first_raw]
+        if not agg and len(raw) <= points:
+            return [[ts, value, value, value] for ts, value in raw]
+        width = max(step, self.bucket if agg else 0)
+        result = []
+        current = None
+        for ts, vmin, vmax, vsum, count in agg:
+            current = self._merge(result, current, ts, vmin, vmax, vsum, count, start, width)
+        for ts, value in raw:
+            current = self._merge(result, current, ts, value, value, value, 1, start, width)
+        if current:
+            result.append(self._finish(current))
+        return result
+
+    def maintain(self, now=None):
+        # Move old raw data to aggregated file, remove data after retention
+        now = time.time() if now is None else now
+        for name in os.listdir(self.path):
+            if name.endswith('.raw'):
+                self._compact(name[:-4], now)
+
+    def remove(self, cap_id):
+        cap_id = str(cap_id)
+        with self._lock:
+            f = self._files.pop(cap_id, None)
+            if f:
+                f.close()
+            self._last.pop(cap_id, None)
+            for path in (self._raw_path(cap_id), self._agg_path(cap_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files = {}
+
+    def _merge(self, result, current, ts, vmin, vmax, vsum, count, start, width):
+        key = start + int((ts - start) / width) * width if width else ts
+        if current and current[0] == key:
+            current[1] = min(current[1], vmin)
+            current[2] = max(current[2], vmax)
+            current[3] += vsum
+            current[4] += count
+            return current
+        if current:
+            result.append(self._finish(current))
+        return [key, vmin, vmax, vsum, count]
+
+    def _finish(self, current):
+        key, vmin, vmax, vsum, count = current
+        return [key, vmin, vmax, round(vsum / count, 6)]
+
+    def _read_last(self, cap_id):
+        path = self._raw_path(cap_id)
+        if not os.path.exists(path):
+            return None
+        size = os.path.getsize(path)
+        if size < RAW.size:
+            return None
+        with open(path, 'rb') as f:
+            f.seek(size - size % RAW.size - RAW.size)
+            return RAW.unpack(f.read(RAW.size))[0]
+
+    def _read_range(self, path, record, start, end):
+        if not os.path.exists(path) or os.path.getsize(path) < record.size:
+            return []
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            count = len(mm) // record.size
+            lo = self._bisect(mm, record, count, start)
+            hi = self._bisect(mm, record, count, end, right=True)
+            if lo >= hi:
+                return []
+            return list(record.iter_unpack(mm[lo * record.size:hi * record.size]))
+
+    def _bisect(self, mm, record, count, ts, right=False):
+        # binary search of first record with timestamp >= ts (> ts for right)
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_ts = struct.unpack_from('<d', mm, mid * record.size)[0]
+            if mid_ts < ts or (right and mid_ts == ts):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _compact(self, cap_id, now):
+        with self._lock:
+            raw_path = self._raw_path(cap_id)
+            border = now - self.raw_retention
+            border -= border % self.bucket  # whole buckets only
+            old = self._read_range(raw_path, RAW, 0, border - 1e-6)
+            if old:
+                buckets = {}
+                for ts, value in old:
+                    key = ts - ts % self.bucket
+                    rec = buckets.get(key)
+                    if rec is None:
+                        buckets[key] = [value, value, value, 1]
+                    else:
+                        rec[0] = min(rec[0], value)
+                        rec[1] = max(rec[1], value)
+                        rec[2] += value
+                        rec[3] += 1
+                with open(self._agg_path(cap_id), 'ab') as f:
+                    for key in sorted(buckets):
+                        f.write(AGG.pack(key, *buckets[key]))
+                keep = self._read_range(raw_path, RAW, border, float('inf'))
+                f = self._files.pop(cap_id, None)
+                if f:
+                    f.close()
+                self._rewrite(raw_path, RAW, keep)
+            agg_path = self._agg_path(cap_id)
+            agg_border = now - self.agg_retention
+            if os.path.exists(agg_path) and self._read_range(agg_path, AGG, 0, agg_border):
+                self._rewrite(agg_path, AGG, self._read_range(agg_path, AGG, agg_border, float('inf')))
+
+    def _rewrite(self, path, record, records):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for rec in records:
+                f.write(record.pack(*rec))
+        os.replace(tmp_path, path)
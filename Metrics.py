@@ -0,0 +1,110 @@
+import re
+import threading
+import urllib.parse
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_ID_RE = re.compile(r'^([0-9a-f]{8}-[0-9a-f-]{27,}|[0-9a-f]{16,}|\d+)$', re.IGNORECASE)
+
+def endpoint_name(url):
+    # https://iot.quasar.yandex.ru/m/user/devices/<uuid>/actions -> iot.quasar.yandex.ru/m/user/devices/{id}/actions
+    parsed = urllib.parse.urlparse(url)
+    parts = ['{id}' if _ID_RE.match(part) else part for part in parsed.path.split('/')]
+    return parsed.netloc + '/'.join(parts).rstrip('/')
+
+class Histogram():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q):
+        # approximate by buckets
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return bound
+        return float('inf')
+
+class Metrics():
+    def __init__(self, prefix='yandexdevices'):
+        self.prefix = prefix
+        self._counters = {}  # name -> {labels: value}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._histograms.setdefault(name, {})
+            if key not in values:
+                values[key] = Histogram(buckets)
+            values[key].observe(value)
+
+    def to_dict(self):
+        with self._lock:
+            result = {'counters': {}, 'gauges': {}, 'histograms': {}}
+            for kind, source in (('counters', self._counters), ('gauges', self._gauges)):
+                for name, values in source.items():
+                    result[kind][name] = [{'labels': dict(key), 'value': value} for key, value in values.items()]
+            for name, values in self._histograms.items():
+                result['histograms'][name] = [{
+                    'labels': dict(key),
+                    'count': hist.count,
+                    'sum': round(hist.sum, 6),
+                    'p50': hist.quantile(0.5),
+                    'p99': hist.quantile(0.99),
+                } for key, hist in values.items()]
+            return result
+
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            for kind, source in (('counter', self._counters), ('gauge', self._gauges)):
+                for name, values in sorted(source.items()):
+                    full_name = f'{self.prefix}_{name}'
+                    lines.append(f'# TYPE {full_name} {kind}')
+                    for key, value in values.items():
+                        lines.append(f'{full_name}{self._labels(key)} {value}')
+            for name, values in sorted(self._histograms.items()):
+                full_name = f'{self.prefix}_{name}'
+                lines.append(f'# TYPE {full_name} histogram')
+                for key, hist in values.items():
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        lines.append(f'{full_name}_bucket{self._labels(key, le=bound)} {count}')
+                    lines.append(f'{full_name}_bucket{self._labels(key, le="+Inf")} {hist.count}')
+                    lines.append(f'{full_name}_sum{self._labels(key)} {hist.sum}')
+                    lines.append(f'{full_name}_count{self._labels(key)} {hist.count}')
+        return '\n'.join(lines) + '\n'
+
+    def _labels(self, key, **extra):
+        items = list(key) + list(extra.items())
+        if not items:
+            return ''
+        labels = ','.join(f'{name}="{self._escape(value)}"' for name, value in items)
+        return '{' + labels + '}'
+
+    def _escape(self, value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
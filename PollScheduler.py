@@ -0,0 +1,100 @@
+import heapq
+import threading
+import time
+
+class PollScheduler():
+    def __init__(self):
+        self._heap = []  # (due, device_id)
+        self._due = {}  # device_id -> due (devices waiting in heap)
+        self._periods = {}  # device_id -> period
+        self._inflight = set()  # devices taken by pop_due and not rescheduled yet
+        self._cond = threading.Condition()
+        self.loaded = False
+
+    def load(self, devices):
+        # devices - list of (device_id, period, seconds until due)
+        with self._cond:
+            self._heap = []
+            self._due = {}
+            self._periods = {}
+            now = time.monotonic()
+            for device_id, period, delay in devices:
+                self._periods[device_id] = period
+                if device_id in self._inflight:
+                    continue
+                self._due[device_id] = now + max(delay, 0)
+                self._heap.append((self._due[device_id], device_id))
+            heapq.heapify(self._heap)
+            self.loaded = True
+            self._cond.notify_all()
+
+    def clear(self):
+        # schedule will be loaded again on next cycle
+        with self._cond:
+            self._heap = []
+            self._due = {}
+            self._periods = {}
+            self.loaded = False
+            self._cond.notify_all()
+
+    def set(self, device_id, period):
+        with self._cond:
+            self._periods[device_id] = period
+            if device_id in self._inflight:
+                return
+            if device_id in self._due:
+                due = min(self._due[device_id], time.monotonic() + period)
+            else:
+                due = time.monotonic()  # new device - poll now
+            self._push(device_id, due)
+
+    def remove(self, device_id):
+        with self._cond:
+            self._periods.pop(device_id, None)
+            self._due.pop(device_id, None)
+
+    def reschedule(self, device_id):
+        # device poll finished - next poll after period
+        with self._cond:
+            self._inflight.discard(device_id)
+            period = self._periods.get(device_id)
+            if period is None:
+                return
+            self._push(device_id, time.monotonic() + period)
+
+    def defer(self, device_id, delay):
+        # device was taken but not polled (account paused) - try again after delay
+        with self._cond:
+            self._inflight.discard(device_id)
+            if device_id in self._periods:
+                self._push(device_id, time.monotonic() + delay)
+
+    def pop_due(self):
+        # Returns list of (device_id, lag seconds) for devices which deadline passed
+        result = []
+        with self._cond:
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                due, device_id = heapq.heappop(self._heap)
+                if self._due.get(device_id) != due:
+                    continue  # stale record
+                del self._due[device_id]
+                self._inflight.add(device_id)
+                result.append((device_id, now - due))
+        return result
+
+    def wait(self, max_wait):
+        # Sleep until the next deadline, schedule change or max_wait
+        with self._cond:
+            timeout = max_wait
+            while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            if self._heap:
+                timeout = min(max_wait, max(self._heap[0][0] - time.monotonic(), 0))
+            if timeout > 0:
+                self._cond.wait(timeout)
+
+    def _push(self, device_id, due):
+        self._due[device_id] = due
+        heapq.heappush(self._heap, (due, device_id))
+        self._cond.notify_all()
@@ -1,91 +1,323 @@
+import contextvars
 import os
 import json
 import requests
 import re
+import tempfile
+import threading
+import time
 import urllib.parse
 import certifi
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from plugins.YandexDevices.RateLimit import TokenBucket, CircuitBreaker, backoff_delay, WRITE_RETRY_STATUS
+from plugins.YandexDevices.Metrics import Metrics, endpoint_name
+
+# [count] of requests made in current poll job (thread or asyncio task), None - not counted
+request_counter = contextvars.ContextVar('request_counter', default=None)
 
 class QuazarApi():
-    def __init__(self, cache_dir, logger):
+    def __init__(self, cache_dir, logger, pool_size=10, csrf_ttl=600, timeout=10, read_rate=10, write_rate=5, max_retries=3, metrics=None, hosts=None):
         self.logger = logger
         self.cache_dir = cache_dir
         self.cookie_path = os.path.join(self.cache_dir,'cookie')
+        self.timeout = timeout
+        self.metrics = metrics or Metrics()
+        self.hosts = hosts or {}  # replace yandex hosts (for emulator), {'https://iot.quasar.yandex.ru': 'http://127.0.0.1:8080'}
+        self._cookie_lock = threading.RLock()
+        self._cookie_mtime = None
+        self._cookie_saved = None
+        self.session = self._create_session(pool_size)
+        self.csrf_ttl = csrf_ttl
+        self._csrf_token = None
+        self._csrf_expire = 0
+        self._csrf_lock = threading.Lock()
+        self.request_count = 0
+        self.read_limit = TokenBucket(read_rate, read_rate * 2)
+        self.write_limit = TokenBucket(write_rate, write_rate * 2)
+        self.breaker = CircuitBreaker()
+        self.authorized = None  # None - unknown, False - stop all requests until authorization
+        self.on_auth_restored = None
+        self._auth_lost = False
+        self.max_retries = max_retries
+        self._count_lock = threading.Lock()
 
-    def api_request(self, url, method='GET', params=None, repeating=0, csrf_token=None, debug=0):
-        # Initialize session and headers
-        headers = {}
-        if method != 'GET' and not csrf_token:
-            csrf_token = self.get_token()  # Retrieve the CSRF token if not already set
-
-        if method != 'GET':
-            headers = {
-                'Content-type': 'application/json',
-                'x-csrf-token': csrf_token
-            }
-
-        # Initialize the session and load cookies from the specified path
+    def _create_session(self, pool_size):
+        # Long-lived session: connections to yandex hosts are kept alive and reused by all threads
         session = requests.Session()
-        # Load cookies from the file using MozillaCookieJar
-        if self.cookie_path is not None and os.path.exists(self.cookie_path):
-            with open(self.cookie_path, 'r') as f:
-                cookies = requests.utils.cookiejar_from_dict(json.load(f))
-                session.cookies.update(cookies)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=False)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'Connection': 'keep-alive'})
+        session.verify = certifi.where()
+        return session
+
+    def _load_cookies(self):
+        # Reload cookie jar only when the cookie file was changed (or removed)
+        with self._cookie_lock:
+            try:
+                mtime = os.stat(self.cookie_path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime == self._cookie_mtime:
+                return
+            self.invalidate_csrf()
+            if mtime is not None and self.authorized is False:
+                self.authorized = None  # new cookie - try again
+            self._cookie_saved = None
+            if mtime is not None:
+                try:
+                    with open(self.cookie_path, 'r') as f:
+                        self._cookie_saved = json.load(f)
+                except (OSError, ValueError) as e:
+                    self.logger.error(f"Error loading cookie: {e}")
+            # New jar is built and then swapped, requests of other threads never see an empty jar
+            self.session.cookies = requests.utils.cookiejar_from_dict(self._cookie_saved or {})
+            self._cookie_mtime = mtime
 
-        # Prepare request and make the API call
-        response = None
+    def _save_cookies(self, path, cookies):
+        # Atomic write: dump to temp file in the same dir and replace
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.cookie')
         try:
-            if method == 'GET':
-                response = session.get(url, headers=headers, cookies=session.cookies)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(requests.utils.dict_from_cookiejar(cookies), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _persist_cookies(self, response):
+        # Persist cookies only if server has changed them
+        if not response.cookies:
+            return
+        self._store_cookies()
+
+    def merge_cookies(self, cookies):
+        # Cookies set by responses of other clients of the account (async)
+        if not cookies:
+            return
+        with self._cookie_lock:
+            self.session.cookies.update(requests.utils.cookiejar_from_dict(cookies))
+        self._store_cookies()
+
+    def _store_cookies(self):
+        with self._cookie_lock:
+            if self._cookie_mtime is None:
+                return
+            cookies = requests.utils.dict_from_cookiejar(self.session.cookies)
+            if cookies == self._cookie_saved:
+                return
+            self._save_cookies(self.cookie_path, self.session.cookies)
+            self._cookie_mtime = os.stat(self.cookie_path).st_mtime_ns
+            self._cookie_saved = cookies
+
+    def api_request(self, url, method='GET', params=None, repeating=0, csrf_token=None, debug=0, background=False):
+        # background - polling requests, lower priority than writes and user requests
+        if isinstance(params, dict):
+            params = json.dumps(params)
+        bucket = self.read_limit if method == 'GET' else self.write_limit
+        max_retries = 1 if background else self.max_retries
+        attempt = 0
+        endpoint = endpoint_name(url)
+        url = self._rewrite(url)
+        # Refresh cookies from the file if it was changed
+        self._load_cookies()
+        while True:
+            if self.authorized is False:
+                if debug:
+                    self.logger.debug(f"SKIP (unauthorized): {method} {url}")
+                self.metrics.inc('api_errors_total', endpoint=endpoint, error='skipped_unauthorized')
+                return None
+
+            if not self.breaker.allow(background):
+                self.metrics.inc('api_errors_total', endpoint=endpoint, error='skipped_breaker')
+                if debug:
+                    self.logger.debug(f"SKIP (upstream is down): {method} {url}")
+                return None
+
+            # Initialize headers
+            headers = {}
+            if method != 'GET' and not csrf_token:
+                csrf_token = self.get_csrf()  # Retrieve the CSRF token if not already set
+                if not csrf_token:
+                    # no token - request is not sent, upstream is not counted as failed
+                    self.logger.error(f"No CSRF token, request skipped: {method} {url}")
+                    self.metrics.inc('api_errors_total', endpoint=endpoint, error='no_csrf')
+                    return None
+
+            if method != 'GET':
+                headers = {
+                    'Content-type': 'application/json',
+                    'x-csrf-token': csrf_token
+                }
+
+            bucket.acquire(priority=not background)
+
+            # Prepare request and make the API call
+            response = None
+            error = None
+            error_class = None
+            retry_after = None
+            retryable = method == 'GET'
+            self._count_request()
+            started = time.monotonic()
+            try:
+                if method == 'GET':
+                    response = self.session.get(url, headers=headers, timeout=self.timeout)
+                else:
+                    response = self.session.request(method, url, data=params, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = f"Request error: {e}"
+                error_class = 'timeout' if isinstance(e, requests.Timeout) else 'network'
+                # write may be already executed by server, repeat only if it was not sent
+                retryable = retryable or self._is_not_sent(e)
             else:
-                if isinstance(params, dict):
-                    params = json.dumps(params)
-                if method == 'POST':
-                    response = session.post(url, data=params, headers=headers, cookies=session.cookies, verify=certifi.where())
+                self._persist_cookies(response)
+                if response.status_code == 429:
+                    error = "Too many requests"
+                    error_class = 'throttled'
+                    retry_after = self._retry_after(response)
+                elif response.status_code >= 500:
+                    error = f"Server error {response.status_code}"
+                    error_class = 'server'
+                retryable = retryable or response.status_code in WRITE_RETRY_STATUS
+            self.metrics.observe('api_request_seconds', time.monotonic() - started, endpoint=endpoint, method=method)
+            self.metrics.inc('api_requests_total', endpoint=endpoint, method=method,
+                             status=response.status_code if response is not None else 'error')
+
+            if error:
+                self.metrics.inc('api_errors_total', endpoint=endpoint, error=error_class)
+                # network error, throttling or server error - retry with backoff
+                self.breaker.failure()
+                if attempt >= max_retries or not retryable:
+                    self.logger.error(f"{error}: {method} {url}")
+                    return None
+                delay = backoff_delay(attempt, retry_after=retry_after)
+                if debug:
+                    self.logger.debug(f"{error}, retry in {delay:.1f}s: {method} {url}")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.success()
+
+            # Process the response
+            result_code = response.status_code
+            if result_code == 401:
+                self.metrics.inc('api_errors_total', endpoint=endpoint, error='unauthorized')
+                if self.authorized is not False:
+                    self.logger.error("Unauthorized access, requests stopped until authorization")
+                self.set_authorized(False)
+                return None
+            if result_code < 400:
+                self.set_authorized(True)
+            try:
+                data = response.json()
+            except ValueError:
+                data = None
+
+            # Handle repeating logic in case of error or unauthorized status
+            if not repeating and (data is None or data.get('code') != 'BAD_REQUEST') and (data is None or result_code == 403 or data.get('status') == 'error'):
+                if debug:
+                    self.logger.debug(f"REPEATING: {method} {url}")
+                if result_code == 403 or self._is_csrf_error(data):
+                    self.metrics.inc('api_errors_total', endpoint=endpoint, error='csrf')
+                    self.invalidate_csrf(csrf_token)
                 else:
-                    response = session.request(method, url, data=params, headers=headers, cookies=session.cookies, verify=certifi.where())
-        except requests.RequestException as e:
-            self.logger.error(f"Request error: {e}")
-            return None
+                    self.metrics.inc('api_errors_total', endpoint=endpoint, error='api_error')
+                csrf_token = ''
+                repeating = 1
+                continue
 
-        # Process the response
-        result_code = response.status_code
-        if result_code == 401:
-            self.logger.error("Unauthorized access")
-            return None
+            return data
+
+    def _rewrite(self, url):
+        for host, target in self.hosts.items():
+            if url.startswith(host + '/'):
+                return target + url[len(host):]
+        return url
+
+    def set_authorized(self, value):
+        self.authorized = value
+        if not value:
+            self._auth_lost = True
+        elif self._auth_lost:
+            self._auth_lost = False
+            if self.on_auth_restored:
+                self.on_auth_restored()
+
+    def _is_not_sent(self, e):
+        # connection was not established, so request did not reach server
+        if isinstance(e, requests.ConnectTimeout):
+            return True
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        return isinstance(e, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+    def _retry_after(self, response):
         try:
-            data = response.json()
+            return float(response.headers.get('Retry-After', 0))
         except ValueError:
-            data = None
+            return None
+
+    def _count_request(self):
+        with self._count_lock:
+            self.request_count += 1
+        counter = request_counter.get()
+        if counter is not None:
+            counter[0] += 1
 
-        # Handle repeating logic in case of error or unauthorized status
-        if not repeating and (data is None or data.get('code') != 'BAD_REQUEST') and (data is None or result_code == 403 or data.get('status') == 'error'):
-            if debug:
-                self.logger.debug(f"REPEATING: {method} {url}")
-            csrf_token = ''
-            return self.api_request(url, method, params, repeating=1, csrf_token=csrf_token, debug=debug)
+    def _is_csrf_error(self, data):
+        if not isinstance(data, dict):
+            return False
+        error = f"{data.get('code', '')} {data.get('message', '')}".lower()
+        return 'csrf' in error
 
-        return data
+    def get_csrf(self):
+        # Cached CSRF token shared by all threads, only one refresh at a time
+        token = self._csrf_token
+        if token and time.monotonic() < self._csrf_expire:
+            return token
+        with self._csrf_lock:
+            if self._csrf_token and time.monotonic() < self._csrf_expire:
+                return self._csrf_token
+            token = self.get_token()
+            if token:
+                self._csrf_token = token
+                self._csrf_expire = time.monotonic() + self.csrf_ttl
+            return token
+
+    def invalidate_csrf(self, token=None):
+        # Drop cached token (only if it is still the one that failed)
+        if token is None or token == self._csrf_token:
+            self._csrf_token = None
+            self._csrf_expire = 0
 
     def get_token(self, url='https://yandex.ru/quasar/iot', error_monitor=False, error_monitor_type=1):
-        # Create a session to maintain cookies
-        session = requests.Session()
-        # Load cookies from the file using MozillaCookieJar
-        if self.cookie_path is not None and os.path.exists(self.cookie_path):
-            with open(self.cookie_path, 'r') as f:
-                cookies = requests.utils.cookiejar_from_dict(json.load(f))
-                session.cookies.update(cookies)
-        
+        self._load_cookies()
+        if self.authorized is False:
+            return False
+
         # Set the necessary headers and parameters for the request
         headers = {
             'Accept-Encoding': 'gzip',
         }
 
-        # Perform the GET request
+        # Perform the GET request (same limits and metrics as api_request)
+        endpoint = endpoint_name(url)
+        self.read_limit.acquire(priority=True)
+        self._count_request()
+        started = time.monotonic()
         try:
-            response = session.get(url, headers=headers, cookies=session.cookies, verify=certifi.where())
+            response = self.session.get(self._rewrite(url), headers=headers, timeout=self.timeout)
         except requests.RequestException as e:
+            self.metrics.observe('api_request_seconds', time.monotonic() - started, endpoint=endpoint, method='GET')
+            self.metrics.inc('api_requests_total', endpoint=endpoint, method='GET', status='error')
+            self.metrics.inc('api_errors_total', endpoint=endpoint, error='timeout' if isinstance(e, requests.Timeout) else 'network')
             self.logger.error(f"Request error: {e}")
             return False
+        self.metrics.observe('api_request_seconds', time.monotonic() - started, endpoint=endpoint, method='GET')
+        self.metrics.inc('api_requests_total', endpoint=endpoint, method='GET', status=response.status_code)
+        self._persist_cookies(response)
 
         # Check if the response contains the CSRF token
         match = re.search(r'"csrfToken2":"(.+?)"', response.text)
@@ -101,6 +333,15 @@ class QuazarApi():
                     self.logger.error("Error: Failed to retrieve csrfToken2 (Verbose)")
             return False
 
+    def get_device_token(self, device_id, platform):
+        # Token for local (glagol) connection to station
+        params = urllib.parse.urlencode({'device_id': device_id, 'platform': platform})
+        data = self.api_request(f'https://quasar.yandex.ru/glagol/token?{params}')
+        if isinstance(data, dict) and data.get('status') == 'ok':
+            return data.get('token')
+        self.logger.error(f"Failed to get device token: {data}")
+        return None
+
     def get_csrf_token(self, cookie_path):
         url = 'https://passport.yandex.ru/am?app_platform=android'
         
@@ -119,9 +360,8 @@ class QuazarApi():
         # Check if the CSRF token is in the response body
         match = re.search(r'"csrf_token" value="(.+?)"', response.text)
 
-        with open(cookie_path, 'w') as f:
-            json.dump(requests.utils.dict_from_cookiejar(session.cookies), f)
-        
+        self._save_cookies(cookie_path, session.cookies)
+
         if match:
             token = match.group(1)
             return token
@@ -190,17 +430,19 @@ class QuazarApi():
 
         if isinstance(data, dict) and (data.get('status','') == 'ok' or data.get('errors', [''])[0] == 'account.auth_passed'):
             # Rename the cookie file (overwrite the existing cookie file)
-            with open(self.cookie_path, 'w') as f:
-                json.dump(requests.utils.dict_from_cookiejar(session.cookies), f)
+            with self._cookie_lock:
+                self._save_cookies(self.cookie_path, session.cookies)
+                self.authorized = None
 
             # Check the cookie with an API request
             check_cookie = self.api_request('https://iot.quasar.yandex.ru/m/user/scenarios')
 
-            if check_cookie['status'] != 'ok':
+            if not isinstance(check_cookie, dict) or check_cookie.get('status') != 'ok':
                 os.remove(self.cookie_path)
                 out['AUTHORIZED'] = False
                 return out
             else:
+                self.set_authorized(True)  # resume requests
                 out['AUTHORIZED'] = True
                 return out
         else:
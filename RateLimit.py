@@ -0,0 +1,96 @@
+import random
+import threading
+import time
+
+class TokenBucket():
+    def __init__(self, rate, burst):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._priority_waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, priority=False, timeout=None):
+        # priority requests are served before background ones
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            if priority:
+                self._priority_waiting += 1
+            try:
+                while True:
+                    self._refill()
+                    if self._tokens >= 1 and (priority or self._priority_waiting == 0):
+                        self._tokens -= 1
+                        return True
+                    wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.05
+                    if deadline is not None:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            return False
+                        wait = min(wait, left)
+                    self._cond.wait(wait)
+            finally:
+                if priority:
+                    self._priority_waiting -= 1
+                    self._cond.notify_all()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+class CircuitBreaker():
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold  # failures in a row to open
+        self.reset_timeout = reset_timeout  # seconds before probe
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        # upstream is down and it is not time to probe
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() - self._opened < self.reset_timeout
+
+    def allow(self, background=False):
+        with self._lock:
+            if self.state == self.CLOSED or not background:
+                return True  # foreground requests also work as probes
+            if self.state == self.OPEN and time.monotonic() - self._opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self.state = self.CLOSED
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self._failures >= self.threshold:
+                self.state = self.OPEN
+                self._opened = time.monotonic()
+
+# writes are repeated only if server did not execute request
+WRITE_RETRY_STATUS = (429, 503)
+
+def backoff_delay(attempt, base=0.5, cap=30, retry_after=None):
+    # exponential backoff with jitter
+    delay = min(cap, base * (2 ** attempt))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if retry_after:
+        delay = max(delay, min(retry_after, cap))
+    return delay
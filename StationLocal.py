@@ -0,0 +1,164 @@
+import json
+import ssl
+import threading
+import time
+import uuid
+import websocket
+
+class LocalStation():
+    # Persistent authenticated connection to station (glagol protocol)
+    def __init__(self, url, token_provider, logger, heartbeat=10, timeout=5):
+        self.url = url
+        self.token_provider = token_provider  # token_provider(refresh) -> token
+        self.logger = logger
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.state = None
+        self._ws = None
+        self._token = None
+        self._waiters = {}  # request id -> [Event, response]
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._retry_at = 0
+        self._backoff = 1
+        self._heartbeat_thread = threading.Thread(name="YandexStationHeartbeat", target=self._heartbeat_loop, daemon=True)
+        self._heartbeat_thread.start()
+
+    @property
+    def connected(self):
+        ws = self._ws
+        return ws is not None and ws.connected
+
+    def send(self, payload, refresh_token=False, connect=True):
+        # Returns station response or None
+        # connect=False - only through open connection (heartbeat)
+        if connect:
+            ws = self._connect(refresh_token)
+        else:
+            ws = self._ws
+            if ws is not None and not ws.connected:
+                ws = None
+        if ws is None:
+            return None
+        request_id = str(uuid.uuid4())
+        waiter = [threading.Event(), None]
+        self._waiters[request_id] = waiter
+        message = {
+            'conversationToken': self._token,
+            'id': request_id,
+            'sentTime': int(time.time() * 1000),
+            'payload': payload,
+        }
+        try:
+            ws.send(json.dumps(message))
+            waiter[0].wait(self.timeout)
+        except (websocket.WebSocketException, OSError) as ex:
+            self.logger.warning(f"Local station {self.url} send error: {ex}")
+            self._disconnect()
+        finally:
+            self._waiters.pop(request_id, None)
+        response = waiter[1]
+        if response and response.get('status') == 'UNAUTHORIZED' and not refresh_token and connect:
+            # token expired - get new one and repeat
+            self._disconnect()
+            return self.send(payload, refresh_token=True)
+        return response
+
+    def close(self):
+        self._closed.set()
+        self._disconnect()
+
+    def _connect(self, refresh_token=False):
+        # Returns connected socket or None, reader thread may reset self._ws at any time
+        with self._lock:
+            ws = self._ws
+            if ws is not None and ws.connected and not refresh_token:
+                return ws
+            if not refresh_token and time.monotonic() < self._retry_at:
+                return None
+            token = self.token_provider(refresh_token)
+            if not token:
+                self.logger.error(f"No device token for local station {self.url}")
+                return None
+            try:
+                ws = websocket.create_connection(self.url, timeout=self.timeout, sslopt={'cert_reqs': ssl.CERT_NONE})
+            except (websocket.WebSocketException, OSError) as ex:
+                # next attempt with exponential delay
+                self._retry_at = time.monotonic() + self._backoff
+                self._backoff = min(self._backoff * 2, 60)
+                self.logger.warning(f"Local station {self.url} connect error: {ex}")
+                return None
+            ws.settimeout(None)
+            self._ws = ws
+            self._token = token
+            self._backoff = 1
+            threading.Thread(name="YandexStationReader", target=self._reader, args=(ws,), daemon=True).start()
+            return ws
+
+    def _disconnect(self):
+        ws = self._ws
+        self._ws = None
+        if ws is not None:
+            try:
+                ws.close()
+            except (websocket.WebSocketException, OSError):
+                pass
+
+    def _reader(self, ws):
+        while not self._closed.is_set():
+            try:
+                message = json.loads(ws.recv())
+            except (websocket.WebSocketException, OSError, ValueError):
+                break
+            if 'state' in message:
+                self.state = message['state']
+            waiter = self._waiters.get(message.get('requestId'))
+            if waiter:
+                waiter[1] = message
+                waiter[0].set()
+        if self._ws is ws:
+            self._disconnect()
+
+    def _heartbeat_loop(self):
+        # keep open connection alive, reconnect is done by next send() with traffic
+        while not self._closed.wait(self.heartbeat):
+            if self._ws is None:
+                continue
+            if self.send({'command': 'ping'}, connect=False) is None:
+                self.logger.debug(f"Local station {self.url} heartbeat failed")
+
+class LocalStationPool():
+    def __init__(self, token_provider, logger, port=1961):
+        self.token_provider = token_provider  # token_provider(station_id, refresh) -> token
+        self.logger = logger
+        self.port = port
+        self._stations = {}
+        self._lock = threading.Lock()
+
+    def get_url(self, ip):
+        if '://' in ip:
+            return ip
+        if ':' not in ip:
+            ip = f'{ip}:{self.port}'
+        return f'wss://{ip}'
+
+    def get(self, station_id, ip):
+        url = self.get_url(ip)
+        with self._lock:
+            station = self._stations.get(station_id)
+            if station is not None and station.url != url:
+                station.close()  # ip changed
+                station = None
+            if station is None:
+                station = LocalStation(url, lambda refresh: self.token_provider(station_id, refresh), self.logger)
+                self._stations[station_id] = station
+            return station
+
+    def send(self, station_id, ip, payload):
+        return self.get(station_id, ip).send(payload)
+
+    def close(self):
+        with self._lock:
+            for station in self._stations.values():
+                station.close()
+            self._stations = {}
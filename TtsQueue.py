@@ -0,0 +1,82 @@
+import itertools
+import queue
+import threading
+import time
+
+class StationQueue():
+    def __init__(self, station_id, speak, logger, dedup_window=10):
+        self.station_id = station_id
+        self.speak = speak  # speak(station_id, message)
+        self.logger = logger
+        self.dedup_window = dedup_window
+        self.queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._recent = {}  # message -> time of enqueue
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.dropped = 0
+        self.last_latency = None
+        self.avg_latency = None
+        self._thread = threading.Thread(name=f"YandexDevicesTTS_{station_id}", target=self._worker, daemon=True)
+        self._thread.start()
+
+    def put(self, message, level=0):
+        now = time.monotonic()
+        with self._lock:
+            # duplicates in short time are dropped
+            last = self._recent.get(message)
+            if last is not None and now - last < self.dedup_window:
+                self.dropped += 1
+                return False
+            self._recent[message] = now
+            if len(self._recent) > 100:
+                self._recent = {msg: ts for msg, ts in self._recent.items() if now - ts < self.dedup_window}
+        # higher level - earlier
+        self.queue.put((-level, next(self._seq), now, message))
+        return True
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize(),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'last_latency': self.last_latency,
+            'avg_latency': self.avg_latency,
+        }
+
+    def _worker(self):
+        while True:
+            _, _, enqueued, message = self.queue.get()
+            try:
+                self.speak(self.station_id, message)
+            except Exception as ex:
+                self.logger.exception(ex)
+            latency = round(time.monotonic() - enqueued, 3)
+            self.sent += 1
+            self.last_latency = latency
+            if self.avg_latency is None:
+                self.avg_latency = latency
+            else:
+                self.avg_latency = round(self.avg_latency * 0.9 + latency * 0.1, 3)
+            self.queue.task_done()
+
+class TtsQueue():
+    def __init__(self, speak, logger, dedup_window=10):
+        self.speak = speak
+        self.logger = logger
+        self.dedup_window = dedup_window
+        self._stations = {}
+        self._lock = threading.Lock()
+
+    def put(self, station_id, message, level=0):
+        with self._lock:
+            station = self._stations.get(station_id)
+            if station is None:
+                station = StationQueue(station_id, self.speak, self.logger, self.dedup_window)
+                self._stations[station_id] = station
+        return station.put(message, level)
+
+    def stats(self):
+        with self._lock:
+            stations = list(self._stations.values())
+        return {station.station_id: station.stats() for station in stations}
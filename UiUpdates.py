@@ -0,0 +1,52 @@
+import threading
+import time
+
+class UiUpdates():
+    # Collects changes of devices and sends them to websocket by one message not often than interval
+    def __init__(self, send, interval=0.5):
+        self._send = send  # send(operation, data)
+        self.interval = interval  # seconds
+        self._pending = {}  # device_id -> {field: value, 'props': {title: {...}}}
+        self._sent = {}  # device_id -> last sent fields
+        self._timer = None
+        self._last_flush = 0
+        self._lock = threading.Lock()
+
+    def device(self, device_id, **fields):
+        with self._lock:
+            sent = self._sent.setdefault(device_id, {})
+            changed = {name: value for name, value in fields.items() if sent.get(name) != value}
+            if not changed:
+                return
+            sent.update(changed)
+            self._pending.setdefault(device_id, {}).update(changed)
+            self._schedule()
+
+    def capability(self, device_id, cap_id, title, value, updated=None):
+        with self._lock:
+            props = self._pending.setdefault(device_id, {}).setdefault('props', {})
+            props[title] = {'id': cap_id, 'value': value, 'updated': updated}
+            self._schedule()
+
+    def forget(self, device_id):
+        with self._lock:
+            self._pending.pop(device_id, None)
+            self._sent.pop(device_id, None)
+
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            pending = self._pending
+            self._pending = {}
+            self._last_flush = time.monotonic()
+        if pending:
+            devices = [dict(changes, id=device_id) for device_id, changes in pending.items()]
+            self._send("updateDevices", {"devices": devices})
+
+    def _schedule(self):
+        if self._timer is not None:
+            return
+        delay = max(0, self._last_flush + self.interval - time.monotonic())
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
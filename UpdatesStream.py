@@ -0,0 +1,105 @@
+import json
+import ssl
+import threading
+import websocket
+
+class UpdatesStream():
+    # Long-lived updates connection of account (same as used by yandex web UI)
+    def __init__(self, get_url, on_devices, on_connect, on_disconnect, logger, heartbeat=30):
+        self.get_url = get_url  # get_url() -> wss url or None
+        self.on_devices = on_devices  # on_devices(list of updated devices)
+        self.on_connect = on_connect  # on_connect(reconnect)
+        self.on_disconnect = on_disconnect
+        self.logger = logger
+        self.heartbeat = heartbeat
+        self.connected = False
+        self.messages = 0
+        self._ws = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(name="YandexDevicesUpdates", target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except (websocket.WebSocketException, OSError):
+                pass
+
+    def _run(self):
+        backoff = 1
+        reconnect = False
+        while not self._stop.is_set():
+            url = self.get_url()
+            ws = None
+            if url:
+                try:
+                    ws = websocket.create_connection(url, timeout=10, sslopt={'cert_reqs': ssl.CERT_REQUIRED})
+                except (websocket.WebSocketException, OSError) as ex:
+                    self.logger.warning(f"Updates stream connect error: {ex}")
+            if ws is None:
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 300)
+                continue
+            backoff = 1
+            ws.settimeout(None)
+            self._ws = ws
+            self.connected = True
+            self.logger.info("Updates stream connected")
+            try:
+                self.on_connect(reconnect)
+                self._receive(ws)
+            finally:
+                self.connected = False
+                self._ws = None
+                try:
+                    ws.close()
+                except (websocket.WebSocketException, OSError):
+                    pass
+                self.logger.info("Updates stream disconnected")
+                self.on_disconnect()
+            reconnect = True
+
+    def _receive(self, ws):
+        stop_ping = threading.Event()
+        threading.Thread(name="YandexDevicesUpdatesPing", target=self._ping, args=(ws, stop_ping), daemon=True).start()
+        try:
+            while not self._stop.is_set():
+                try:
+                    raw = ws.recv()
+                except (websocket.WebSocketException, OSError):
+                    return
+                if not raw:
+                    continue
+                try:
+                    message = json.loads(raw)
+                    if message.get('operation') != 'update_states':
+                        continue
+                    data = message.get('message')
+                    if isinstance(data, str):
+                        data = json.loads(data)
+                except ValueError as ex:
+                    self.logger.warning(f"Wrong updates message: {ex}")
+                    continue
+                self.messages += 1
+                try:
+                    self.on_devices(data.get('updated_devices', []))
+                except Exception as ex:
+                    self.logger.exception(ex)
+        finally:
+            stop_ping.set()
+
+    def _ping(self, ws, stop):
+        while not stop.wait(self.heartbeat):
+            try:
+                ws.ping()
+            except (websocket.WebSocketException, OSError):
+                return
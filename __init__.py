@@ -1,8 +1,14 @@
+import asyncio
 import datetime
+import hashlib
+import json
 import os
 import re
 import threading
-from flask import redirect, request, jsonify, render_template
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from flask import redirect, request, jsonify, render_template, Response
 from app.authentication.handlers import handle_admin_required
 from plugins.YandexDevices.models.YaDevices import YaDevices
 from plugins.YandexDevices.models.YaStation import YaStation
@@ -12,9 +18,36 @@ from app.core.lib.object import setProperty, getProperty, callMethod, setLinkToO
 from app.core.lib.cache import deleteFromCache, getCacheDir
 from plugins.YandexDevices.forms.SettingForms import SettingsForm
 from app.database import session_scope, row2dict, get_now_to_utc
-from plugins.YandexDevices.QuazarApi import QuazarApi
+from plugins.YandexDevices.QuazarApi import QuazarApi, request_counter
+from plugins.YandexDevices.PollScheduler import PollScheduler
+from plugins.YandexDevices.Metrics import Metrics
+from plugins.YandexDevices.CapabilityCache import CapabilityCache, LinkIndex
+from plugins.YandexDevices.CapabilityValues import normalize_value, value_to_str, is_changed
+from plugins.YandexDevices.DeviceCommands import CommandBatcher, build_action
+from plugins.YandexDevices.TtsQueue import TtsQueue
+from plugins.YandexDevices.StationLocal import LocalStationPool
+from plugins.YandexDevices.UpdatesStream import UpdatesStream
+from plugins.YandexDevices.History import HistoryStore
+from plugins.YandexDevices.UiUpdates import UiUpdates
+from plugins.YandexDevices.DeviceSync import payload_devices, diff_devices
 from time import sleep
-from sqlalchemy import and_, select, distinct
+from sqlalchemy import and_, or_, select, distinct, inspect, text, func
+from sqlalchemy.orm import aliased
+
+# таблицы для имен сценариев (id станции -> русские буквы)
+MASK_EN = '0123456789abcdef-'
+MASK_RU = 'оеаинтсрвлкмдпуяы'
+ENCODE_TABLE = str.maketrans(MASK_EN, MASK_RU)
+DECODE_TABLE = str.maketrans(MASK_RU, MASK_EN)
+
+def payload_hash(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def account_filter(column, account):
+    # аккаунт по умолчанию - пустое значение (записи до поддержки нескольких аккаунтов)
+    if account:
+        return column == account
+    return or_(column.is_(None), column == '')
 
 class YandexDevices(BasePlugin):
 
@@ -30,8 +63,139 @@ class YandexDevices(BasePlugin):
     def initialization(self):
         cache_dir = os.path.join(getCacheDir(), self.name)
         os.makedirs(cache_dir, exist_ok=True)
-        self.quazar = QuazarApi(cache_dir, self.logger)
-        pass
+        self.metrics = Metrics()
+        self.last_cycle_requests = 0  # запросы заданий опроса последнего завершенного цикла
+        self.entries_stats = {"processed": 0, "skipped": 0}
+        self.last_cycle_entries = dict(self.entries_stats)
+        self._polling = set()
+        self._poll_lock = threading.Lock()
+        self._device_locks = {}  # device_id -> Lock, опрос, поток обновлений и сверка одного устройства по очереди
+        self.scheduler = PollScheduler()
+        # аккаунты Яндекс: '' - основной, остальные из настроек
+        # у каждого свои cookie, CSRF, пул соединений, лимиты запросов, потоки опроса и поток обновлений
+        self.accounts = {}
+        self._poll_executors = {}
+        self.updates_streams = {}
+        for account in [''] + self.config.get('accounts', []):
+            self.init_account(cache_dir, account)
+        self.quazar = self.accounts['']
+        # asyncio: запросы всех аккаунтов в одном потоке, работа с БД в пуле потоков
+        self.engine = None
+        self.async_accounts = {}
+        if self.config.get('async_engine', False):
+            try:
+                from plugins.YandexDevices.AsyncEngine import AsyncEngine
+                from plugins.YandexDevices.AsyncQuazarApi import AsyncQuazarApi
+            except ImportError as ex:
+                self.logger.error(f"Async engine is not available ({ex}), use threads")
+            else:
+                self.engine = AsyncEngine(self.logger)
+                self.async_accounts = {account: AsyncQuazarApi(api, self.config.get('max_in_flight', 200)) for account, api in self.accounts.items()}
+                self._db_executor = ThreadPoolExecutor(max_workers=self.config.get('poll_workers', 8), thread_name_prefix="YandexDevicesDB")
+        self.device_accounts = {}  # device_id -> account
+        self.device_iots = {}  # device_id -> iot_id
+        self.iot_accounts = {}  # iot_id -> account
+        self.migrate()
+        self.load_device_accounts()
+        self.cap_cache = CapabilityCache()
+        self.link_index = LinkIndex()
+        self.load_link_index()
+        self.commands = CommandBatcher(self.send_actions, self.config.get('command_window', 100) / 1000)
+        self.local_stations = LocalStationPool(self.get_station_token, self.logger)
+        self.tts_modes = {}  # iot_id -> 'direct'/'scenario'
+        self.tts_queue = TtsQueue(self.speak, self.logger, self.config.get('tts_dedup_window', 10))
+        # история значений для выбранных возможностей
+        self.history = HistoryStore(os.path.join(cache_dir, 'history'), self.config.get('history_days', 7) * 86400)
+        self.history_caps = set(self.config.get('history', []))
+        self._history_maintained = 0
+        # изменения для интерфейса отправляются пачками
+        self.ui_updates = UiUpdates(self.sendDataToWebsocket, self.config.get('ui_interval', 500) / 1000)
+        self._etag_base = int(time.time())
+        self._data_version = 0  # меняется только при изменении данных устройств, для ETag
+        self.last_sync = None  # результат последней синхронизации списка устройств
+        self._payload_hashes = {}  # name -> hash of last payload
+        self._scenarios = {}  # account -> {decoded name -> scenario}
+        self.station_scenarios = {}  # iot_id -> tts scenario id
+        self._encoded_names = {}  # iot_id -> name of scenario
+
+    def stop_cycle(self):
+        super().stop_cycle()
+        # потоки обновлений останавливаются только здесь: cyclic_task после остановки не выполняется
+        for stream in self.updates_streams.values():
+            stream.stop()
+        self.local_stations.close()
+        self.stop_engine()
+
+    def stop_engine(self):
+        # закрытие сессий aiohttp и остановка цикла событий
+        if not self.engine:
+            return
+        async def close_all():
+            # gather создается внутри цикла событий
+            await asyncio.gather(*(api.close() for api in self.async_accounts.values()))
+        try:
+            self.engine.run(close_all(), timeout=5)
+        except Exception as ex:
+            self.logger.error(f"Error closing async sessions: {ex}")
+        self.engine.stop()
+        self._db_executor.shutdown(wait=False)
+        self.engine = None
+
+    def init_account(self, cache_dir, account):
+        if account:
+            cache_dir = os.path.join(cache_dir, 'accounts', account)
+            os.makedirs(cache_dir, exist_ok=True)
+        api = QuazarApi(cache_dir, self.logger, self.config.get('pool_size', 10), timeout=self.config.get('request_timeout', 10),
+                        read_rate=self.config.get('read_rate', 10), write_rate=self.config.get('write_rate', 5), metrics=self.metrics)
+        api.on_auth_restored = self.scheduler.clear  # опрос возобновляется после авторизации
+        self.accounts[account] = api
+        # пул потоков опроса устройств аккаунта
+        self._poll_executors[account] = ThreadPoolExecutor(max_workers=self.config.get('poll_workers', 8), thread_name_prefix=f"YandexDevice{account}")
+        self.updates_streams[account] = UpdatesStream(partial(self.get_updates_url, account), self.on_stream_devices,
+                                                      partial(self.on_stream_connect, account=account), self.on_stream_disconnect, self.logger)
+
+    def migrate(self):
+        # колонки, добавленные в существующие таблицы (можно запускать повторно)
+        with session_scope() as session:
+            inspector = inspect(session.get_bind())
+            for model in (YaDevices, YaStation):
+                table = model.__tablename__
+                if not inspector.has_table(table):
+                    continue  # новая установка - таблица будет создана целиком
+                columns = [column['name'] for column in inspector.get_columns(table)]
+                if 'account' not in columns:
+                    session.execute(text(f'ALTER TABLE {table} ADD COLUMN account VARCHAR(100)'))
+                    self.logger.info(f"Added column account to {table}")
+            session.commit()
+
+    def api(self, account=None):
+        # None - аккаунт удален из настроек, запросы с cookie другого аккаунта не отправляются
+        api = self.accounts.get(account or '')
+        if api is None:
+            self.logger.error(f"Unknown Yandex account '{account}'")
+        return api
+
+    def async_api(self, account=None):
+        api = self.async_accounts.get(account or '')
+        if api is None:
+            self.logger.error(f"Unknown Yandex account '{account}'")
+        return api
+
+    def auth_state(self):
+        # False - хотя бы один аккаунт без авторизации
+        states = [api.authorized for api in self.accounts.values()]
+        if False in states:
+            return False
+        if None in states:
+            return None
+        return True
+
+    def load_device_accounts(self):
+        with session_scope() as session:
+            rows = session.query(YaDevices.id, YaDevices.iot_id, YaDevices.account).all()
+        self.device_accounts = {device_id: account or '' for device_id, _, account in rows}
+        self.device_iots = {device_id: iot_id for device_id, iot_id, _ in rows}
+        self.iot_accounts = {iot_id: account or '' for _, iot_id, account in rows}
 
     def admin(self, request):
         op = request.args.get('op', '')
@@ -44,35 +208,45 @@ class YandexDevices(BasePlugin):
             type = request.args.get('type', '')
             track_id = request.args.get('track_id', '')
             csrf_token = request.args.get('csrf_token', '')
+            account = request.args.get('account', '')
+            if account not in self.accounts:
+                account = ''
+            quazar = self.api(account)
             if type == 'qr':
                 if track_id:
-                    out = self.quazar.confirmQrCode(track_id,csrf_token)
-                    return self.render('yandexdevices_auth.html', out)
-
+                    out = quazar.confirmQrCode(track_id,csrf_token)
                 else:
-                    out = self.quazar.getQrCode()
-                    return self.render('yandexdevices_auth.html', out)
+                    out = quazar.getQrCode()
+                out = dict(out or {}, ACCOUNT=account, ACCOUNTS=list(self.accounts.keys()))
+                return self.render('yandexdevices_auth.html', out)
 
             if type == 'reset':
-                deleteFromCache("cookie",self.name)
+                if account:
+                    if os.path.exists(quazar.cookie_path):
+                        os.remove(quazar.cookie_path)
+                else:
+                    deleteFromCache("cookie",self.name)
             # check authorized
-            data = self.quazar.api_request('https://iot.quasar.yandex.ru/m/user/devices')
+            data = quazar.api_request('https://iot.quasar.yandex.ru/m/user/devices')
             if data:
                 auth = True
             content = {
                 "AUTHORIZED": auth,
+                "ACCOUNT": account,
+                "ACCOUNTS": list(self.accounts.keys()),
             }
             return self.render('yandexdevices_auth.html', content)
 
         if op == 'update':
             self.refresh_stations()
             self.update_devices()
-            return redirect("YandexDevices")
+            self.scheduler.clear()
+            return redirect("YandexDevices?tab=devices")
 
         if op == "generate_dev_token":
             id = request.args.get('id', None)
             req = YaStation.get_by_id(id)
-            self.get_device_token(req.station_id, req.platform)
+            self.get_device_token(req.station_id, req.platform, req.account)
             return redirect("?station=" + id + "&op=edit")
 
         if op == 'edit':
@@ -86,43 +260,91 @@ class YandexDevices(BasePlugin):
         if op == 'delete':
             if device:
                 with session_scope() as session:
-                    session.query(YaDevices).filter(YaDevices.id == device).delete(synchronize_session=False)
+                    cap_ids = self.remove_devices(session, [int(device)])
                     session.commit()
+                for cap_id in cap_ids:
+                    self.set_history(cap_id, False)
+                self.saveConfig()
+                self.forget_device(int(device))
             if station:
                 with session_scope() as session:
                     session.query(YaStation).filter(YaStation.id == station).delete(synchronize_session=False)
                     session.commit()
+                self._payload_hashes.clear()  # станция будет добавлена при следующем обновлении
 
         settings = SettingsForm()
         if request.method == 'GET':
             settings.get_data.data = self.config.get('get_device_data',False)
             settings.update_period.data = self.config.get('update_period',60)
             settings.update_linked.data = self.config.get('update_linked',True)
+            settings.pool_size.data = self.config.get('pool_size',10)
+            settings.bulk_refresh.data = self.config.get('bulk_refresh',False)
+            settings.poll_workers.data = self.config.get('poll_workers',8)
+            settings.request_timeout.data = self.config.get('request_timeout',10)
+            settings.command_window.data = self.config.get('command_window',100)
+            settings.updates_stream.data = self.config.get('updates_stream',False)
+            settings.deadband.data = self.config.get('deadband',0)
+            settings.read_rate.data = self.config.get('read_rate',10)
+            settings.write_rate.data = self.config.get('write_rate',5)
+            settings.history_days.data = self.config.get('history_days',7)
+            settings.ui_interval.data = self.config.get('ui_interval',500)
+            settings.accounts.data = ', '.join(self.config.get('accounts',[]))
+            settings.async_engine.data = self.config.get('async_engine',False)
         else:
             if settings.validate_on_submit():
                 self.config["get_device_data"] = settings.get_data.data
                 self.config["update_linked"] = settings.update_linked.data
+                self.config["pool_size"] = settings.pool_size.data or 10
+                self.config["bulk_refresh"] = settings.bulk_refresh.data
+                self.config["poll_workers"] = settings.poll_workers.data or 8
+                self.config["request_timeout"] = settings.request_timeout.data or 10
+                for api in self.accounts.values():
+                    api.timeout = self.config["request_timeout"]
+                self.config["command_window"] = settings.command_window.data if settings.command_window.data is not None else 100
+                self.commands.window = self.config["command_window"] / 1000
+                self.config["updates_stream"] = settings.updates_stream.data
+                self.config["deadband"] = settings.deadband.data or 0
+                self.config["read_rate"] = settings.read_rate.data or 10
+                self.config["write_rate"] = settings.write_rate.data or 5
+                self.config["history_days"] = settings.history_days.data or 7
+                self.history.raw_retention = self.config["history_days"] * 86400
+                self.config["ui_interval"] = settings.ui_interval.data if settings.ui_interval.data is not None else 500
+                self.ui_updates.interval = self.config["ui_interval"] / 1000
+                self.config["update_period"] = settings.update_period.data or 60
+                accounts = [re.sub(r'[^\w-]', '', name) for name in (settings.accounts.data or '').split(',')]
+                self.config["accounts"] = [name for name in dict.fromkeys(accounts) if name]
+                self.config["async_engine"] = settings.async_engine.data
+                self.scheduler.clear()
                 self.saveConfig()
 
         if tab == 'devices':
-            devices = YaDevices.query.all()
-            devices = [row2dict(device) for device in devices]
+            # список устройств загружается страницами через /YandexDevices/devices
             content = {
-                "devices": devices,
                 "tab": tab,
+                "last_sync": self.last_sync,
                 'form': settings,
+                'auth_state': self.auth_state(),
+                'accounts': self.accounts_state(),
             }
             return self.render('yandexdevices_devices.html', content)
 
         stations = YaStation.query.all()
         stations = [row2dict(station) for station in stations]
+        tts_stats = self.tts_queue.stats()
+        for station in stations:
+            station['tts_queue'] = tts_stats.get(station['id'])
         content = {
             'stations': stations,
             "tab": tab,
             'form': settings,
+            'auth_state': self.auth_state(),
+            'accounts': self.accounts_state(),
         }
         return self.render('yandexdevices_stations.html', content)
 
+    def accounts_state(self):
+        return {account: api.authorized for account, api in self.accounts.items()}
+
     def route_index(self):
         @self.blueprint.route('/YandexDevices/device', methods=['POST'])
         @self.blueprint.route('/YandexDevices/device/<device_id>', methods=['GET', 'POST'])
@@ -130,15 +352,22 @@ class YandexDevices(BasePlugin):
         def point_yandex_device(device_id=None):
             with session_scope() as session:
                 if request.method == "GET":
-                    dev = session.query(YaDevices).filter(YaDevices.id == device_id).one()
-                    device = row2dict(dev)
-                    device['props'] = []
-                    props = session.query(YaCapabilities).filter(YaCapabilities.device_id == device_id).order_by(YaCapabilities.title)
-                    for prop in props:
-                        item = row2dict(prop)
-                        item['read_only'] = item['read_only'] == 1
-                        device['props'].append(item)
-                    return jsonify(device)
+                    etag = self.get_etag()
+                    if request.if_none_match.contains(etag):
+                        return Response(status=304, headers={'ETag': f'"{etag}"'})
+                    rows = (
+                        session.query(YaDevices, YaCapabilities)
+                        .outerjoin(YaCapabilities, YaCapabilities.device_id == YaDevices.id)
+                        .filter(YaDevices.id == device_id)
+                        .order_by(YaCapabilities.title)
+                        .all()
+                    )
+                    if not rows:
+                        return jsonify({'error': 'Device not found'}), 404
+                    device = self.devices_to_list(rows)[0]
+                    response = jsonify(device)
+                    response.set_etag(etag)
+                    return response
                 if request.method == "POST":
                     data = request.get_json()
                     if data['id']:
@@ -160,92 +389,397 @@ class YandexDevices(BasePlugin):
                         prop_rec.read_only = 1 if prop['read_only'] else 0
                         if prop_rec.linked_object and prop_rec.read_only == 0:
                             setLinkToObject(prop_rec.linked_object, prop_rec.linked_property, self.name)
+                        self.cap_cache.update_links(prop_rec)
+                        self.set_history(prop_rec.id, prop.get('history', False))
+                        self.link_index.set(device.id, device.iot_id, prop_rec.title, prop_rec.linked_object, prop_rec.linked_property)
 
                     session.commit()
+                    self.saveConfig()
+                    self.data_changed()
+                    self.update_schedule(device)
 
                     return 'Device updated successfully', 200
 
+        @self.blueprint.route('/YandexDevices/devices', methods=['GET'])
+        @handle_admin_required
+        def yandex_devices_list():
+            # ?page=&per_page=&room=&type=&props=0
+            etag = self.get_etag()
+            if request.if_none_match.contains(etag):
+                return Response(status=304, headers={'ETag': f'"{etag}"'})
+            page = max(request.args.get('page', 1, type=int), 1)
+            per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
+            room = request.args.get('room')
+            device_type = request.args.get('type')
+            account = request.args.get('account')
+            with_props = request.args.get('props', '1') != '0'
+            with session_scope() as session:
+                query = session.query(YaDevices)
+                if room:
+                    query = query.filter(YaDevices.room == room)
+                if device_type:
+                    query = query.filter(YaDevices.device_type == device_type)
+                if account is not None and account in self.accounts:
+                    query = query.filter(account_filter(YaDevices.account, account))
+                total = query.count()
+                page_query = query.order_by(YaDevices.room, YaDevices.title).limit(per_page).offset((page - 1) * per_page)
+                if with_props:
+                    # страница устройств и их возможности одним запросом
+                    page_devices = page_query.subquery()
+                    device = aliased(YaDevices, page_devices)
+                    rows = (
+                        session.query(device, YaCapabilities)
+                        .outerjoin(YaCapabilities, YaCapabilities.device_id == device.id)
+                        .order_by(device.room, device.title, YaCapabilities.title)
+                        .all()
+                    )
+                    changes = None
+                else:
+                    rows = [(dev, None) for dev in page_query.all()]
+                    # время последнего изменения значений устройств страницы
+                    changes = dict(
+                        session.query(YaCapabilities.device_id, func.max(YaCapabilities.updated))
+                        .filter(YaCapabilities.device_id.in_([dev.id for dev, _ in rows]))
+                        .group_by(YaCapabilities.device_id)
+                        .all()
+                    )
+                devices = self.devices_to_list(rows, with_props, changes)
+                rooms = [row[0] for row in session.query(distinct(YaDevices.room)).order_by(YaDevices.room)]
+                types = [row[0] for row in session.query(distinct(YaDevices.device_type)).order_by(YaDevices.device_type)]
+            response = jsonify({
+                'devices': devices,
+                'total': total,
+                'page': page,
+                'per_page': per_page,
+                'rooms': rooms,
+                'types': types,
+            })
+            response.set_etag(etag)
+            return response
+
+        @self.blueprint.route('/YandexDevices/metrics', methods=['GET'])
+        @handle_admin_required
+        def yandex_devices_metrics():
+            self.update_metrics()
+            return Response(self.metrics.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+        @self.blueprint.route('/YandexDevices/metrics.json', methods=['GET'])
+        @handle_admin_required
+        def yandex_devices_metrics_json():
+            self.update_metrics()
+            return jsonify(self.metrics.to_dict())
+
+        @self.blueprint.route('/YandexDevices/history/<int:cap_id>', methods=['GET'])
+        @handle_admin_required
+        def yandex_devices_history(cap_id):
+            # ?start=&end= - unix time, по умолчанию последние 7 дней; points - количество точек
+            end = request.args.get('end', time.time(), type=float)
+            start = request.args.get('start', end - 7 * 86400, type=float)
+            points = request.args.get('points', 500, type=int)
+            return jsonify({
+                'id': cap_id,
+                'start': start,
+                'end': end,
+                'points': self.history.query(cap_id, start, end, points),  # [time, min, max, avg]
+            })
+
+    def get_etag(self):
+        # значения возможностей, синхронизация списка и изменение связей; опрос без изменений ETag не меняет
+        return f"{self._etag_base}-{self._data_version}"
+
+    def data_changed(self):
+        with self._poll_lock:
+            self._data_version += 1
+
+    def devices_to_list(self, rows, with_props=True, changes=None):
+        # rows - (device, capability) из запроса с outer join
+        # changes - device_id -> время последнего изменения значений, если возможности не выбирались
+        # updated устройства - время последнего изменения, а не опроса: ответ меняется вместе с ETag
+        devices = {}
+        last_changes = dict(changes or {})
+        for dev, prop in rows:
+            device = devices.get(dev.id)
+            if device is None:
+                device = row2dict(dev)
+                if with_props:
+                    device['props'] = []
+                devices[dev.id] = device
+            if prop is not None:
+                item = row2dict(prop)
+                item['read_only'] = item['read_only'] == 1
+                item['history'] = prop.id in self.history_caps
+                device['props'].append(item)
+                if prop.updated and (last_changes.get(dev.id) is None or prop.updated > last_changes[dev.id]):
+                    last_changes[dev.id] = prop.updated
+        for device_id, device in devices.items():
+            changed = last_changes.get(device_id)
+            device['updated'] = str(changed) if changed else None
+        return list(devices.values())
+
+    def load_link_index(self):
+        with session_scope() as session:
+            rows = (
+                session.query(YaCapabilities.device_id, YaDevices.iot_id, YaCapabilities.title, YaCapabilities.linked_object, YaCapabilities.linked_property)
+                .join(YaDevices, YaDevices.id == YaCapabilities.device_id)
+                .filter(YaCapabilities.linked_object.isnot(None), YaCapabilities.linked_object != "")
+                .all()
+            )
+            self.link_index.load(rows)
+
     def cyclic_task(self):
         # self.refresh_stations()
         if self.config.get("get_device_data", False):
+            for stream in self.updates_streams.values():
+                if self.config.get("updates_stream", False):
+                    stream.start()
+                else:
+                    stream.stop()
             self.refresh_devices_data()
+            if time.monotonic() - self._history_maintained > 3600:
+                self._history_maintained = time.monotonic()
+                self.history.maintain()
+            if not self.event.is_set():
+                self.scheduler.wait(5.0)  # до ближайшего опроса
+        else:
+            for stream in self.updates_streams.values():
+                stream.stop()
+            self.event.wait(1.0)
 
-        self.event.wait(1.0)
+    def load_schedule(self):
+        with session_scope() as session:
+            # Получение списка устройств
+            update_linked = self.config.get('update_linked',True)
+            if update_linked:
+                # Подзапрос для выборки уникальных device_id из YaCapabilities
+                subquery = (
+                    select(distinct(YaCapabilities.device_id))
+                    .where(
+                        and_(
+                            YaCapabilities.linked_object is not None,
+                            YaCapabilities.linked_object != ""
+                        )
+                    )
+                )
+                # Основной запрос для выборки устройств из YaDevices
+                devices = (
+                    session.query(YaDevices)
+                    .filter(YaDevices.id.in_(subquery))  # Фильтруем по результатам подзапроса
+                    .all()
+                )
+            else:
+                devices = session.query(YaDevices).all()  # Все устройства
+            now = get_now_to_utc()
+            schedule = []
+            for device in devices:
+                if (device.account or '') not in self.accounts:
+                    continue  # аккаунт удален из настроек
+                period = self.get_update_period(device)
+                delay = 0
+                if device.updated:
+                    delay = (device.updated + datetime.timedelta(seconds=period) - now).total_seconds()
+                schedule.append((device.id, period, delay))
+                self.device_accounts[device.id] = device.account or ''
+                self.device_iots[device.id] = device.iot_id
+        self.scheduler.load(schedule)
+        self.logger.debug(f"Loaded schedule for {len(schedule)} devices")
+
+    def get_update_period(self, device):
+        period = device.update_period
+        if period is None:
+            period = self.config.get("update_period", 60)  # get default period from settings
+        stream = self.updates_streams.get(device.account or '')
+        if stream and stream.connected:
+            # данные приходят через поток, опрос только для сверки
+            period = max(period, self.config.get("stream_sweep_period", 600))
+        return period
+
+    def get_updates_url(self, account=''):
+        data = self.api(account).api_request('https://iot.quasar.yandex.ru/m/v3/user/devices', background=True)
+        if isinstance(data, dict):
+            return data.get('updates_url')
+        return None
+
+    def on_stream_connect(self, reconnect, account=''):
+        self.scheduler.clear()
+        if reconnect:
+            # обновления за время разрыва потеряны - сверяем все устройства аккаунта
+            with session_scope() as session:
+                device_ids = [row.id for row in session.query(YaDevices.id).filter(account_filter(YaDevices.account, account)).all()]
+            self._submit_poll(('bulk', account), self.refresh_devices_bulk, device_ids, account, account=account)
+
+    def on_stream_disconnect(self):
+        self.scheduler.clear()
+
+    def on_stream_devices(self, devices):
+        devices = {device['id']: device for device in devices if isinstance(device, dict) and 'id' in device}
+        if not devices:
+            return
+        with session_scope() as session:
+            rows = session.query(YaDevices.id, YaDevices.iot_id).filter(YaDevices.iot_id.in_(list(devices.keys()))).all()
+        for device_id, iot_id in rows:
+            self.refresh_device_data(device_id, devices[iot_id], partial=True)
+
+    def update_schedule(self, device):
+        # обновление расписания опроса после изменения устройства
+        if not self.scheduler.loaded:
+            return
+        if self.config.get('update_linked',True):
+            with session_scope() as session:
+                linked = session.query(YaCapabilities.id).filter(
+                    YaCapabilities.device_id == device.id,
+                    YaCapabilities.linked_object.isnot(None),
+                    YaCapabilities.linked_object != ""
+                ).first()
+            if not linked:
+                self.scheduler.remove(device.id)
+                return
+        self.device_accounts[device.id] = device.account or ''
+        self.device_iots[device.id] = device.iot_id
+        self.scheduler.set(device.id, self.get_update_period(device))
 
     def update_devices(self):
+        report = {'added': [], 'changed': [], 'removed': []}
+        for account in self.accounts:
+            result = self.update_account_devices(account)
+            if result:
+                for name, titles in result.items():
+                    report[name].extend(titles)
+        self.last_sync = dict(report, time=str(get_now_to_utc()))
+        self.load_device_accounts()
+        return report
+
+    def update_account_devices(self, account=''):
         try:
-            data = self.quazar.api_request('https://iot.quasar.yandex.ru/m/user/devices')
+            data = self.api(account).api_request('https://iot.quasar.yandex.ru/m/user/devices')
             self.logger.debug(data)
+            if not isinstance(data, dict) or not isinstance(data.get("rooms"), list):
+                return None  # без корректного ответа ничего не удаляем
+            devices = payload_devices(data)
             with session_scope() as session:
-                for room in data["rooms"]:
-                    for device in room["devices"]:
-                        quasar_id = None
-                        if 'quasar_info' in device:
-                            quasar_id = device['quasar_info']['device_id']
-                        rec = session.query(YaDevices).filter(YaDevices.iot_id == device['id']).one_or_none()
-                        if not rec:
-                            rec = YaDevices()
-                            rec.iot_id = device['id']
-                            session.add(rec)
-                        rec.title = device['name']
-                        rec.device_type = device['type']
-                        rec.room = room['name']
-                        rec.icon = device['icon_url']
-                        rec.updated = get_now_to_utc()
-                        session.commit()
-
-                        # обновление станций
-                        rec_station = session.query(YaStation).filter(YaStation.title == device['name']).one_or_none()
-
-                        if not rec_station and quasar_id:
-                            rec_station = session.query(YaStation).filter(YaStation.station_id == quasar_id).one_or_none()
+                diff = diff_devices(session.query(YaDevices).filter(account_filter(YaDevices.account, account)).all(), devices)
+                now = get_now_to_utc()
+                for iot_id, fields in diff.added.items():
+                    rec = YaDevices(iot_id=iot_id, updated=now, account=account, **fields)
+                    session.add(rec)
+                for rec, changed in diff.changed.values():
+                    for name, value in changed.items():
+                        setattr(rec, name, value)
+                removed_ids = [rec.id for rec in diff.removed]
+                removed_caps = self.remove_devices(session, removed_ids)
+
+                # обновление станций
+                stations = session.query(YaStation).filter(account_filter(YaStation.account, account)).all()
+                by_title = {station.title: station for station in stations}
+                by_station_id = {station.station_id: station for station in stations if station.station_id}
+                for iot_id, (fields, quasar_id) in devices.items():
+                    rec_station = by_title.get(fields['title'])
+                    if not rec_station and quasar_id:
+                        rec_station = by_station_id.get(quasar_id)
+                    if rec_station and rec_station.iot_id != iot_id:
+                        rec_station.iot_id = iot_id
+                        rec_station.updated = now
+                session.commit()
 
-                        if rec_station:
-                            rec_station.iot_id = device['id']
-                            rec_station.updated = get_now_to_utc()
-                            session.commit()
+                for device_id in removed_ids:
+                    self.forget_device(device_id)
+                for cap_id in removed_caps:
+                    self.set_history(cap_id, False)
+                if removed_caps:
+                    self.saveConfig()
+                if diff.added:
+                    for rec in session.query(YaDevices).filter(YaDevices.iot_id.in_(list(diff.added.keys()))).all():
+                        self.update_schedule(rec)
+            report = diff.report()
+            if diff:
+                self.logger.info(f"Devices synced{' (' + account + ')' if account else ''}: added {len(report['added'])}, changed {len(report['changed'])}, removed {len(report['removed'])}")
+                self.data_changed()
+            return report
 
         except Exception as ex:
             self.logger.error(ex)
+            return None
+
+    def remove_devices(self, session, device_ids):
+        # удаление устройств с возможностями, возвращает id удаленных возможностей
+        if not device_ids:
+            return []
+        caps = session.query(YaCapabilities).filter(YaCapabilities.device_id.in_(device_ids)).all()
+        for cap in caps:
+            if cap.linked_object and cap.linked_property:
+                removeLinkFromObject(cap.linked_object, cap.linked_property, self.name)
+        session.query(YaCapabilities).filter(YaCapabilities.device_id.in_(device_ids)).delete(synchronize_session=False)
+        session.query(YaDevices).filter(YaDevices.id.in_(device_ids)).delete(synchronize_session=False)
+        return [cap.id for cap in caps]
+
+    def forget_device(self, device_id):
+        self.scheduler.remove(device_id)
+        self.device_accounts.pop(device_id, None)
+        self.device_iots.pop(device_id, None)
+        self.cap_cache.drop(device_id)
+        self.link_index.drop_device(device_id)
+        self.ui_updates.forget(device_id)
+        self.data_changed()
+        with self._poll_lock:
+            self._device_locks.pop(device_id, None)
 
     def refresh_stations(self):
-        data = self.quazar.api_request('https://quasar.yandex.ru/devices_online_stats')
+        for account in self.accounts:
+            self.refresh_account_stations(account)
+
+    def refresh_account_stations(self, account=''):
+        data = self.api(account).api_request('https://quasar.yandex.ru/devices_online_stats')
+        if not isinstance(data, dict):
+            return
 
         if isinstance(data.get('items'), list):
             items = data['items']
-            with session_scope() as session:
-                for item in items:
-                    if item['platform'] not in ['iot_app_android','iot_app_ios','alice_app_ios']: #remove unused platforms
-                        station_id = item['id']
-                        rec = session.query(YaStation).filter(YaStation.station_id == station_id).one_or_none()
-
-                        if not rec:
-                            rec = YaStation()
-                            rec.station_id = item['id']
-                            session.add(rec)
-                            session.commit()
-
-                        rec.title = item['name']
-                        rec.icon = item['icon']
-                        rec.platform = item['platform']
-                        rec.screen_capable = int(item['screen_capable'])
-                        rec.screen_present = int(item['screen_present'])
-                        rec.online = int(item['online'])
-
-                        session.commit()
-
-            self.add_scenarios()
-
-    def add_scenarios(self):
-        data = self.quazar.api_request('https://iot.quasar.yandex.ru/m/user/scenarios')
-        scenarios = {}
-
-        if isinstance(data.get('scenarios'), list):
-            for scenario in data['scenarios']:
-                scenarios[self.yandex_decode(scenario['name'])] = scenario
+            digest = payload_hash(items)
+            # список станций не изменился - в БД писать нечего
+            if digest != self._payload_hashes.get(('stations', account)):
+                with session_scope() as session:
+                    stations = {station.station_id: station for station in session.query(YaStation).filter(account_filter(YaStation.account, account)).all()}
+                    for item in items:
+                        if item['platform'] not in ['iot_app_android','iot_app_ios','alice_app_ios']: #remove unused platforms
+                            rec = stations.get(item['id'])
+                            if not rec:
+                                rec = YaStation()
+                                rec.station_id = item['id']
+                                rec.account = account
+                                session.add(rec)
+                                stations[item['id']] = rec
+                            fields = {
+                                'title': item['name'],
+                                'icon': item['icon'],
+                                'platform': item['platform'],
+                                'screen_capable': int(item['screen_capable']),
+                                'screen_present': int(item['screen_present']),
+                                'online': int(item['online']),
+                            }
+                            for name, value in fields.items():
+                                if getattr(rec, name) != value:
+                                    setattr(rec, name, value)
+                    session.commit()
+                self._payload_hashes[('stations', account)] = digest
+
+            self.add_scenarios(account)
+
+    def add_scenarios(self, account=''):
+        quazar = self.api(account)
+        data = quazar.api_request('https://iot.quasar.yandex.ru/m/user/scenarios')
+        if not isinstance(data, dict):
+            return
+        digest = payload_hash(data.get('scenarios'))
+        if digest != self._payload_hashes.get(('scenarios', account)):
+            scenarios = {}
+            if isinstance(data.get('scenarios'), list):
+                for scenario in data['scenarios']:
+                    scenarios[self.yandex_decode(scenario['name'])] = scenario
+            self._scenarios[account] = scenarios
+            self._payload_hashes[('scenarios', account)] = digest
+        scenarios = self._scenarios.get(account, {})
 
         with session_scope() as session:
-            stations = session.query(YaStation).all()
+            stations = session.query(YaStation).filter(account_filter(YaStation.account, account)).all()
             for station in stations:
                 station_id = station.iot_id
                 if not station_id:
@@ -286,90 +820,255 @@ class YandexDevices(BasePlugin):
                         }]
                     }
 
-                    result = self.quazar.api_request('https://iot.quasar.yandex.ru/m/user/scenarios/', 'POST', payload)
-                    if result.get('status') == 'ok':
+                    result = quazar.api_request('https://iot.quasar.yandex.ru/m/user/scenarios/', 'POST', payload)
+                    if isinstance(result, dict) and result.get('status') == 'ok':
                         station.tts_scenario = result.get('scenario_id')
-                        session.commit()
-                else:
+                elif station.tts_scenario != scenarios[station_id.lower()]['id']:
                     station.tts_scenario = scenarios[station_id.lower()]['id']
-                    session.commit()
+                self.station_scenarios[station_id] = station.tts_scenario
+            session.commit()
 
     def yandex_encode(self, in_str):
-        in_str = in_str.lower()
-        MASK_EN = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'a', 'b', 'c', 'd', 'e', 'f', '-']
-        MASK_RU = ['о', 'е', 'а', 'и', 'н', 'т', 'с', 'р', 'в', 'л', 'к', 'м', 'д', 'п', 'у', 'я', 'ы']
-        translation_table = str.maketrans(''.join(MASK_EN), ''.join(MASK_RU))
-        return 'осис ' + in_str.translate(translation_table)
+        name = self._encoded_names.get(in_str)
+        if name is None:
+            name = 'осис ' + in_str.lower().translate(ENCODE_TABLE)
+            self._encoded_names[in_str] = name
+        return name
 
     def yandex_decode(self, in_str):
         in_str = in_str[5:]  # Removing the "oсис " prefix
-        MASK_EN = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'a', 'b', 'c', 'd', 'e', 'f', '-']
-        MASK_RU = ['о', 'е', 'а', 'и', 'н', 'т', 'с', 'р', 'в', 'л', 'к', 'м', 'д', 'п', 'у', 'я', 'ы']
-        translation_table = str.maketrans(''.join(MASK_RU), ''.join(MASK_EN))
-        return in_str.translate(translation_table)
+        return in_str.translate(DECODE_TABLE)
 
     def refresh_devices_data(self):
-        with session_scope() as session:
-            self.logger.debug("Begin get data devices")
-
-            # Получение списка устройств
-            update_linked = self.config.get('update_linked',True)
-            if update_linked:
-                # Подзапрос для выборки уникальных device_id из YaCapabilities
-                subquery = (
-                    select(distinct(YaCapabilities.device_id))
-                    .where(
-                        and_(
-                            YaCapabilities.linked_object is not None,
-                            YaCapabilities.linked_object != ""
-                        )
-                    )
-                )
-                # Основной запрос для выборки устройств из YaDevices
-                devices = (
-                    session.query(YaDevices)
-                    .filter(YaDevices.id.in_(subquery))  # Фильтруем по результатам подзапроса
-                    .all()
-                )
+        if not self.scheduler.loaded:
+            self.load_schedule()
+
+        due_devices = self.scheduler.pop_due()
+        if not due_devices:
+            return
+        self.logger.debug("Begin get data devices")
+        # время опроса после дедлайна
+        for _, lag in due_devices:
+            self.metrics.observe('poll_lag_seconds', lag)
+        self.metrics.set('poll_lag_max_seconds', round(max(lag for _, lag in due_devices), 3))
+        # left = 1 - цикл удерживается, пока задания отправляются, иначе быстрое задание завершит его раньше времени
+        cycle = {'started': time.monotonic(), 'left': 1, 'jobs': 0, 'requests': 0}
+
+        with self._poll_lock:
+            self.last_cycle_entries = self.entries_stats
+            self.entries_stats = {"processed": 0, "skipped": 0}
+
+        # опрос разделен по аккаунтам: у каждого свои лимиты запросов и потоки
+        shards = {}
+        for device_id, _ in due_devices:
+            shards.setdefault(self.device_accounts.get(device_id, ''), []).append(device_id)
+
+        bulk_refresh = self.config.get('bulk_refresh', False)
+        polled = 0
+        for account, device_ids in shards.items():
+            api = self.api(account)
+            if api is None:
+                for device_id in device_ids:
+                    self.scheduler.remove(device_id)
+                continue
+            if api.authorized is False or api.breaker.is_open():
+                # нет авторизации или сервис недоступен - опрос аккаунта приостановлен
+                for device_id in device_ids:
+                    self.scheduler.defer(device_id, 5.0)
+                continue
+            if bulk_refresh:
+                if self._submit_poll(('bulk', account), self.refresh_devices_bulk, device_ids, account, None, cycle, cycle=cycle, account=account):
+                    polled += len(device_ids)
+                else:
+                    for device_id in device_ids:
+                        self.scheduler.reschedule(device_id)
             else:
-                devices = session.query(YaDevices).all()  # Все устройства
-            threads = []
-            for device in devices:
-
-                period = device.update_period
-                if period is None:
-                    period = self.config.get("update_period", 60)  # get default period from settings
-                dt = device.updated + datetime.timedelta(seconds=period)
-                if get_now_to_utc() < dt:
-                    continue
-                t = threading.Thread(name="YandexDevice_" + device.title,target=self.refresh_device_data, args=(device.id,))
-                threads.append(t)
-                t.start()
-
-            # Ожидание завершения всех потоков
-            for event in threads:
-                event.join()  # Ожидаем, пока каждый закончит работу
+                for device_id in device_ids:
+                    if self._submit_poll(device_id, self.refresh_device_data, device_id, cycle=cycle, account=account):
+                        polled += 1
+                    else:
+                        self.scheduler.reschedule(device_id)
+
+        self._release_cycle(cycle)
+
+        self.metrics.inc('poll_devices_due_total', len(due_devices))
+        self.metrics.inc('poll_devices_polled_total', polled)
+        self.metrics.set('poll_devices_due', len(due_devices))
+        self.metrics.set('poll_devices_polled', polled)
+
+        self.logger.debug(f"End get data devices: {len(due_devices)} devices, {self.last_cycle_requests} requests, {self.last_cycle_entries['processed']} processed/{self.last_cycle_entries['skipped']} skipped values in previous cycle ({'bulk' if bulk_refresh else 'per device'})")
+
+    def _submit_poll(self, key, func, *args, cycle=None, account=''):
+        with self._poll_lock:
+            if key in self._polling:
+                return False
+            self._polling.add(key)
+            if cycle is not None:
+                cycle['left'] += 1
+                cycle['jobs'] += 1
+        if self.engine:
+            future = self.engine.submit(self._poll_async(func, args, cycle))
+        else:
+            executor = self._poll_executors.get(account) or self._poll_executors['']
+            future = executor.submit(self._poll_job, func, args, cycle)
+        future.add_done_callback(lambda f: self._poll_done(key, f, cycle))
+        return True
+
+    def _poll_job(self, func, args, cycle):
+        # запросы задания учитываются в цикле опроса
+        counter = [0]
+        token = request_counter.set(counter)
+        try:
+            func(*args)
+        finally:
+            request_counter.reset(token)
+            self._count_cycle_requests(cycle, counter[0])
+
+    async def _poll_async(self, func, args, cycle):
+        # запрос в цикле событий, обработка ответа в пуле потоков БД
+        counter = [0]
+        request_counter.set(counter)  # только в контексте этой задачи
+        try:
+            if func == self.refresh_device_data:
+                args = (args[0], await self.fetch_device_async(args[0]))
+            elif func == self.refresh_devices_bulk:
+                device_ids, account = args[:2]
+                api = self.async_api(account)
+                data = await api.api_request('https://iot.quasar.yandex.ru/m/v3/user/devices', background=True) if api else None
+                states = self.parse_devices_states(data)
+                args = (device_ids, account, states if states is not None else False) + args[3:]
+        finally:
+            self._count_cycle_requests(cycle, counter[0])
+        await asyncio.get_running_loop().run_in_executor(self._db_executor, func, *args)
+
+    def _count_cycle_requests(self, cycle, count):
+        if cycle is None:
+            return
+        with self._poll_lock:
+            cycle['requests'] += count
+
+    def _poll_done(self, key, future, cycle=None):
+        with self._poll_lock:
+            self._polling.discard(key)
+        self._release_cycle(cycle)
+        if not isinstance(key, tuple):  # ('bulk', account) - устройства перепланируются в refresh_devices_bulk
+            self.scheduler.reschedule(key)
+        ex = future.exception()
+        if ex:
+            self.logger.error(f"Poll error: {ex}", exc_info=ex)
+
+    def _release_cycle(self, cycle):
+        if cycle is None:
+            return
+        with self._poll_lock:
+            cycle['left'] -= 1
+            if cycle['left'] != 0 or not cycle['jobs']:
+                return
+        # длительность цикла - до завершения последнего опроса
+        self.metrics.observe('poll_cycle_seconds', time.monotonic() - cycle['started'])
+        self.last_cycle_requests = cycle['requests']
+        self.metrics.set('poll_cycle_requests', self.last_cycle_requests)
 
-            self.logger.debug("End get data devices")
+    def refresh_devices_bulk(self, device_ids, account='', states=None, cycle=None):
+        pending = set(device_ids)
+        try:
+            with session_scope() as session:
+                devices = session.query(YaDevices.id, YaDevices.iot_id).filter(YaDevices.id.in_(device_ids)).all()
+            if states is None:
+                states = self.get_devices_states(account)
+            if not isinstance(states, dict):
+                # запрос не удался - не опрашиваем устройства по одному, вся группа ждет следующего периода
+                self.logger.warning(f"Bulk refresh failed{' (' + account + ')' if account else ''}, {len(device_ids)} devices postponed")
+                return
+            for device_id, iot_id in devices:
+                if iot_id in states:
+                    self.refresh_device_data(device_id, states[iot_id])
+                    pending.discard(device_id)
+                    self.scheduler.reschedule(device_id)
+                elif self._submit_poll(device_id, self.refresh_device_data, device_id, cycle=cycle, account=account):
+                    # нет данных в общем списке - запрашиваем устройство отдельно
+                    pending.discard(device_id)
+        finally:
+            for device_id in pending:
+                self.scheduler.reschedule(device_id)
+
+    def get_devices_states(self, account=''):
+        # Состояние всех устройств дома одним запросом: iot_id -> данные устройства, None - ошибка запроса
+        api = self.api(account)
+        if api is None:
+            return None
+        data = api.api_request('https://iot.quasar.yandex.ru/m/v3/user/devices', background=True)
+        return self.parse_devices_states(data)
+
+    def parse_devices_states(self, data):
+        if not isinstance(data, dict):
+            return None
+        states = {}
+        devices = []
+        for household in data.get('households', []):
+            devices.extend(household.get('all', []))
+        for room in data.get('rooms', []):
+            devices.extend(room.get('devices', []))
+        devices.extend(data.get('unconfigured_devices', []))
+        for device in devices:
+            if not isinstance(device, dict) or 'id' not in device:
+                continue
+            if 'capabilities' not in device and 'properties' not in device:
+                continue
+            states[device['id']] = device
+        return states
+
+    def device_iot(self, id):
+        # iot_id и аккаунт устройства без открытия сессии, если устройство известно
+        iot_id = self.device_iots.get(id)
+        if iot_id is None:
+            with session_scope() as session:
+                row = session.query(YaDevices.iot_id, YaDevices.account).filter(YaDevices.id == id).one_or_none()
+            if not row:
+                return None, ''
+            iot_id = row.iot_id
+            self.device_iots[id] = iot_id
+            self.device_accounts[id] = row.account or ''
+        return iot_id, self.device_accounts.get(id, '')
+
+    def fetch_device(self, id):
+        # Запрос информации об устройстве, False - ошибка запроса
+        iot_id, account = self.device_iot(id)
+        api = self.api(account) if iot_id else None
+        if api is None:
+            return False
+        data = api.api_request(f"https://iot.quasar.yandex.ru/m/user/devices/{iot_id}", background=True)
+        return data if data is not None else False
 
-    def refresh_device_data(self, id):
-        with session_scope() as session:
+    async def fetch_device_async(self, id):
+        iot_id, account = await asyncio.get_running_loop().run_in_executor(self._db_executor, self.device_iot, id)
+        api = self.async_api(account) if iot_id else None
+        if api is None:
+            return False
+        data = await api.api_request(f"https://iot.quasar.yandex.ru/m/user/devices/{iot_id}", background=True)
+        return data if data is not None else False
+
+    def device_lock(self, device_id):
+        with self._poll_lock:
+            lock = self._device_locks.get(device_id)
+            if lock is None:
+                lock = self._device_locks[device_id] = threading.Lock()
+            return lock
+
+    def refresh_device_data(self, id, data=None, partial=False):
+        started = time.monotonic()
+        if data is None:
+            # сессия БД открывается только после ответа
+            data = self.fetch_device(id)
+        with self.device_lock(id), session_scope() as session:
             device = session.query(YaDevices).filter(YaDevices.id == id).one_or_none()
             if not device:
                 return
             self.logger.info(f"Begin get data device - {device.title}({device.room})")
-            # Узнаем IOT_ID
-            iot_id = device.iot_id
-
-            # Запрос информации об устройстве
-            data = self.quazar.api_request(
-                f"https://iot.quasar.yandex.ru/m/user/devices/{iot_id}"
-            )
             self.logger.debug(data)
             if not isinstance(data, dict):
                 device.updated = get_now_to_utc()
                 session.commit()
-                self.sendDataToWebsocket("updateDevice", row2dict(device))
                 self.logger.info(f"End get data device - {device.title}({device.room})")
                 return
 
@@ -377,14 +1076,18 @@ class YandexDevices(BasePlugin):
             if "state" in data:
                 current_status = 1 if data["state"] == "online" else 0
 
-            online_array = {
-                "type": "devices",
-                "state": {"value": current_status},
-                "parameters": {"instance": "online"},
-            }
             if "properties" not in data:
                 data["properties"] = []
-            data["properties"].append(online_array)
+            # в частичном обновлении статус есть не всегда
+            if not partial or "state" in data:
+                online_array = {
+                    "type": "devices",
+                    "state": {"value": current_status},
+                    "parameters": {"instance": "online"},
+                }
+                data["properties"].append(online_array)
+
+            deadband = self.config.get("deadband", 0)
 
             # Цикл по всем возможностям устройства
             if isinstance(data.get("capabilities"), list):
@@ -402,18 +1105,9 @@ class YandexDevices(BasePlugin):
                     else:
                         c_type += ".unknown"
 
-                    req_skill = (
-                        session.query(YaCapabilities)
-                        .filter(
-                            YaCapabilities.title == c_type,
-                            YaCapabilities.device_id == device.id,
-                        )
-                        .one_or_none()
-                    )
-                    if not req_skill:
-                        req_skill = YaCapabilities(title=c_type, device_id=device.id)
-                        session.add(req_skill)
-                        session.commit()
+                    req_skill = self.cap_cache.get(session, device.id, c_type)
+                    if not self.is_updated_upstream(req_skill, capability):
+                        continue
 
                     # Основные возможности, меняем значение
                     value = None
@@ -429,21 +1123,23 @@ class YandexDevices(BasePlugin):
                         else:
                             value = "?"
 
-                    new_value = value
-                    old_value = req_skill.value
+                    new_value = normalize_value(c_type, value)
+                    old_value = normalize_value(c_type, req_skill.value)
+                    changed = is_changed(c_type, new_value, old_value, deadband)
+
+                    if changed:
+                        req_skill.set_value(value_to_str(new_value), get_now_to_utc())
+                        self.value_changed(device.id, req_skill, new_value)
 
-                    if req_skill.linked_object and req_skill.linked_property:
+                    if (changed or req_skill.push) and req_skill.linked_object and req_skill.linked_property:
                         linked_object_property = (
                             f"{req_skill.linked_object}.{req_skill.linked_property}"
                         )
                         updateProperty(linked_object_property, new_value, self.name)
+                        self.metrics.inc('linked_pushes_total', kind='property')
+                    req_skill.push = False
 
-                    if new_value != old_value:
-                        req_skill.value = str(new_value)
-                        req_skill.updated = get_now_to_utc()
-                        session.commit()
-
-                    if new_value != old_value and req_skill.linked_object and req_skill.linked_method:
+                    if changed and req_skill.linked_object and req_skill.linked_method:
                         method_params = {
                             "NEW_VALUE": new_value,
                             "OLD_VALUE": old_value,
@@ -456,40 +1152,39 @@ class YandexDevices(BasePlugin):
                             method_params,
                             self.name,
                         )
+                        self.metrics.inc('linked_pushes_total', kind='method')
 
             # Значения датчиков
             if isinstance(data.get("properties"), list):
                 for property in data["properties"]:
                     p_type = f"{property['type']}.{property['parameters']['instance']}"
 
-                    req_prop = (
-                        session.query(YaCapabilities).filter(YaCapabilities.title == p_type,YaCapabilities.device_id == device.id).one_or_none()
-                    )
-                    if not req_prop:
-                        req_prop = YaCapabilities(title=p_type, device_id=device.id)
-                        session.add(req_prop)
-                        session.commit()
+                    req_prop = self.cap_cache.get(session, device.id, p_type)
+                    if not self.is_updated_upstream(req_prop, property):
+                        continue
 
                     # Основные датчики
                     value = None
                     if property["state"]:
                         value = property["state"].get("value")
 
-                    new_value = value
-                    old_value = req_prop.value
+                    new_value = normalize_value(p_type, value)
+                    old_value = normalize_value(p_type, req_prop.value)
+                    changed = is_changed(p_type, new_value, old_value, deadband)
 
-                    if req_prop.linked_object and req_prop.linked_property:
+                    if changed:
+                        req_prop.set_value(value_to_str(new_value), get_now_to_utc())
+                        self.value_changed(device.id, req_prop, new_value)
+
+                    if (changed or req_prop.push) and req_prop.linked_object and req_prop.linked_property:
                         linked_object_property = (
                             f"{req_prop.linked_object}.{req_prop.linked_property}"
                         )
                         setProperty(linked_object_property, new_value, self.name)
+                        self.metrics.inc('linked_pushes_total', kind='property')
+                    req_prop.push = False
 
-                    if new_value != old_value:
-                        req_prop.value = new_value
-                        req_prop.updated = get_now_to_utc()
-                        session.commit()
-
-                    if new_value != old_value and req_prop.linked_object and req_prop.linked_method:
+                    if changed and req_prop.linked_object and req_prop.linked_method:
                         method_params = {
                             "NEW_VALUE": new_value,
                             "OLD_VALUE": old_value,
@@ -502,23 +1197,73 @@ class YandexDevices(BasePlugin):
                             method_params,
                             self.name,
                         )
+                        self.metrics.inc('linked_pushes_total', kind='method')
 
+            # изменения возможностей пишем одной транзакцией
+            writes = self.cap_cache.flush(session, device.id)
             device.updated = get_now_to_utc()
             session.commit()
-            self.sendDataToWebsocket("updateDevice", row2dict(device))
+            # при ошибке commit изменения остаются в кэше и будут записаны при следующем опросе
+            self.cap_cache.committed(writes)
+            self.metrics.inc('db_writes_total', len(writes) + 1)
+            self.metrics.observe('device_poll_seconds', time.monotonic() - started)
+            if writes:
+                self.data_changed()  # новый ETag только после записи в БД
+                # время обновления отправляем только вместе с изменениями
+                self.ui_updates.device(device.id, updated=str(device.updated), online=current_status)
             self.logger.info(f"End get data device - {device.title}({device.room})")
 
+    def is_updated_upstream(self, state, item):
+        # пропускаем значения, которые не менялись с прошлого опроса
+        last_updated = item.get("last_updated")
+        if last_updated is not None and state.upstream_ts is not None and last_updated <= state.upstream_ts and not state.push:
+            self._count_entry("skipped")
+            return False
+        state.upstream_ts = last_updated
+        self._count_entry("processed")
+        return True
+
+    def set_history(self, cap_id, enabled):
+        if enabled and cap_id not in self.history_caps:
+            self.history_caps.add(cap_id)
+        elif not enabled and cap_id in self.history_caps:
+            self.history_caps.discard(cap_id)
+            self.history.remove(cap_id)
+        self.config['history'] = sorted(self.history_caps)
+
+    def value_changed(self, device_id, state, value):
+        self.ui_updates.capability(device_id, state.id, state.title, state.value, str(state.updated))
+        # в историю пишутся только числовые значения
+        if state.id in self.history_caps and isinstance(value, (int, float)):
+            self.history.append(state.id, float(value))
+
+    def _count_entry(self, name):
+        with self._poll_lock:
+            self.entries_stats[name] += 1
+        self.metrics.inc('values_total', result=name)
+
+    def update_metrics(self):
+        # текущие значения для отдачи метрик
+        for account, api in self.accounts.items():
+            self.metrics.set('authorized', 1 if api.authorized is not False else 0, account=account)
+            self.metrics.set('circuit_open', 0 if api.breaker.state == 'closed' else 1, account=account)
+            self.metrics.set('updates_stream_connected', 1 if self.updates_streams[account].connected else 0, account=account)
+        with self._poll_lock:
+            self.metrics.set('poll_in_flight', len(self._polling))
+        for station_id, stats in self.tts_queue.stats().items():
+            self.metrics.set('tts_queue_depth', stats['depth'], station=station_id)
+            if stats['avg_latency'] is not None:
+                self.metrics.set('tts_latency_seconds', stats['avg_latency'], station=station_id)
+
     def changeLinkedProperty(self, obj, prop, val):
-        with session_scope() as session:
-            properties = session.query(YaCapabilities).filter(YaCapabilities.linked_object == obj, YaCapabilities.linked_property == prop).all()
-            if len(properties) == 0:
-                from app.core.lib.object import removeLinkFromObject
-                removeLinkFromObject(obj, prop, self.name)
-                return
-            for property in properties:
-                device = session.query(YaDevices).filter(YaDevices.id == property.device_id).one_or_none()
-                if device:
-                    self.setDataDevice(device, property, val)
+        links = self.link_index.get(obj, prop)
+        if len(links) == 0:
+            from app.core.lib.object import removeLinkFromObject
+            removeLinkFromObject(obj, prop, self.name)
+            return
+        for iot_id, title, _ in links:
+            if iot_id:
+                self.setDataDevice(iot_id, title, val)
 
     def say(self, message, level=0, args=None):
         with session_scope() as session:
@@ -538,18 +1283,28 @@ class YandexDevices(BasePlugin):
                 minlevel = int(minlevel)
                 if level < minlevel:
                     continue
-                if station.tts == 1:  # local TTS
-                    self.send_command_to_station(station, 'повтори за мной ' + message)
-                elif station.tts == 2:  # cloud TTS
-                    if len(message) >= 100:
-                        sentences = re.split(r'\.\.\.|[.!?]\s*', message)
-                        for sentence in sentences:
-                            pause = int(len(sentence) / 8 + 1)  # экспериментально
-                            self.send_cloud_TTS(station, sentence)
-                            self.logger.info(sentence)
-                            sleep(pause)
-                    else:
-                        self.send_cloud_TTS(station, message)
+                # отправка в очередь станции, не ждем произнесения
+                self.tts_queue.put(station.id, message, level)
+
+    def speak(self, station_id, message):
+        with session_scope() as session:
+            station = session.query(YaStation).filter(YaStation.id == station_id).one_or_none()
+            if not station:
+                return
+            session.expunge(station)
+
+        if station.tts == 1:  # local TTS
+            self.send_command_to_station(station, 'повтори за мной ' + message)
+        elif station.tts == 2:  # cloud TTS
+            if len(message) >= 100:
+                sentences = re.split(r'\.\.\.|[.!?]\s*', message)
+                for sentence in sentences:
+                    pause = int(len(sentence) / 8 + 1)  # экспериментально
+                    self.send_cloud_TTS(station, sentence)
+                    self.logger.info(sentence)
+                    sleep(pause)
+            else:
+                self.send_cloud_TTS(station, message)
 
     def widget(self):
         with session_scope() as session:
@@ -558,31 +1313,74 @@ class YandexDevices(BasePlugin):
             content = {}
             content['stations'] = len(stations)
             content['devices'] = len(devices)
+            content['auth_state'] = self.auth_state()
         return render_template("widget_yandexdevices.html",**content)
 
-    def setDataDevice(self, device: YaDevices, property: YaCapabilities, value):
-        if property.title == "devices.capabilities.on_off":
-            if value == 1:
-                value = True
-            else:
-                value = False
+    def setDataDevice(self, iot_id: str, title: str, value):
+        try:
+            action = build_action(title, value)
+        except (TypeError, ValueError) as ex:
+            self.logger.error(f"Wrong value '{value}' for {title}: {ex}")
+            return
+        if action is None:
+            self.logger.warning(f"{title} is read only")
+            return
+        # команды одного устройства в пределах окна отправляются одним запросом
+        self.commands.add(iot_id, action)
+
+    def api_call(self, account, url, method='GET', params=None):
+        # синхронный вызов для потоков плагина (команды, TTS), при async_engine запрос выполняется в цикле событий
+        api = self.async_api(account) if self.engine else self.api(account)
+        if api is None:
+            return None
+        if self.engine:
+            return self.engine.run(api.api_request(url, method, params))
+        return api.api_request(url, method, params)
+
+    def send_actions(self, iot_id: str, actions: list):
         payload = {
-            "actions": [
-                {
-                    "type": property.title,
-                    "state": {
-                        "instance": "on",
-                        "value": value
-                    }
-                }
-            ]
+            "actions": actions
         }
 
-        result = self.quazar.api_request('https://iot.quasar.yandex.ru/m/user/devices/' + device.iot_id + '/actions', 'POST', payload)
+        result = self.api_call(self.iot_accounts.get(iot_id), 'https://iot.quasar.yandex.ru/m/user/devices/' + iot_id + '/actions', 'POST', payload)
         self.logger.debug(result)
 
+    def get_device_token(self, station_id, platform, account=None):
+        api = self.api(account)
+        token = api.get_device_token(station_id, platform) if api else None
+        if token:
+            with session_scope() as session:
+                stations = session.query(YaStation).filter(YaStation.station_id == station_id, account_filter(YaStation.account, account)).all()
+                for station in stations:
+                    station.device_token = token
+                session.commit()
+        return token
+
+    def get_station_token(self, id, refresh=False):
+        with session_scope() as session:
+            station = session.query(YaStation).filter(YaStation.id == id).one_or_none()
+            if not station:
+                return None
+            token = station.device_token
+            station_id = station.station_id
+            platform = station.platform
+            account = station.account
+        if refresh or not token:
+            token = self.get_device_token(station_id, platform, account)
+        return token
+
     def send_command_to_station(self, station, command):
-        pass
+        if not station.ip:
+            self.logger.error(f"Not set IP for local station {station.title}")
+            return False
+        self.logger.info(f"Sending local '{command}' to {station.title}")
+        payload = {
+            'command': 'sendText',
+            'text': command,
+        }
+        result = self.local_stations.send(station.id, station.ip, payload)
+        self.logger.debug(result)
+        return isinstance(result, dict) and result.get('status') == 'SUCCESS'
 
     def send_command_to_stationCloud(self, station, command):
         with session_scope() as session:
@@ -590,6 +1388,16 @@ class YandexDevices(BasePlugin):
             if ystation and command:
                 self.send_cloud_TTS(ystation,command,'text_action')
 
+    def send_direct_TTS(self, station: YaStation, message: str, action='phrase_action'):
+        # True - отправлено, False - отклонено API, None - ответа нет (сеть, лимиты, авторизация)
+        payload = {
+            "actions": [build_action(f'devices.capabilities.quasar.server_action.{action}', message)]
+        }
+        result = self.api_call(station.account, f'https://iot.quasar.yandex.ru/m/user/devices/{station.iot_id}/actions', 'POST', payload)
+        if not isinstance(result, dict):
+            return None
+        return result.get('status') == 'ok'
+
     def send_cloud_TTS(self, station: YaStation, message: str, action='phrase_action'):
 
         # Cleaning up the phrase as per the PHP code logic
@@ -603,7 +1411,19 @@ class YandexDevices(BasePlugin):
         # Debug logging if error monitoring is enabled
         self.logger.info(f"Sending cloud '{action}: {message}' to {station.title}")
 
-        if not station.tts_scenario:
+        # Прямая отправка действия на станцию одним запросом
+        if station.iot_id and self.tts_modes.get(station.iot_id, 'direct') == 'direct':
+            sent = self.send_direct_TTS(station, message, action)
+            if sent:
+                self.tts_modes[station.iot_id] = 'direct'
+                return True
+            if sent is False:
+                self.logger.warning(f"Direct TTS rejected by {station.title}, use scenario")
+                self.tts_modes[station.iot_id] = 'scenario'
+            # ошибка запроса - сценарий только для этого сообщения
+
+        scenario_id = self.station_scenarios.get(station.iot_id) or station.tts_scenario
+        if not scenario_id:
             return False
 
         name_encode = self.yandex_encode(station.iot_id)
@@ -639,12 +1459,11 @@ class YandexDevices(BasePlugin):
             }]
         }
 
-        scenario_id = station.tts_scenario
-        result = self.quazar.api_request(f'https://iot.quasar.yandex.ru/m/v4/user/scenarios/{scenario_id}', 'PUT', payload)
+        result = self.api_call(station.account, f'https://iot.quasar.yandex.ru/m/v4/user/scenarios/{scenario_id}', 'PUT', payload)
 
         if isinstance(result, dict) and result.get('status') == 'ok':
             payload = {}
-            result = self.quazar.api_request(f'https://iot.quasar.yandex.ru/m/user/scenarios/{scenario_id}/actions', 'POST', payload)
+            result = self.api_call(station.account, f'https://iot.quasar.yandex.ru/m/user/scenarios/{scenario_id}/actions', 'POST', payload)
 
             if isinstance(result, dict) and result.get('status') == 'ok':
                 return True
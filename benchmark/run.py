@@ -0,0 +1,265 @@
+"""Offline benchmark of YandexDevices plugin with emulated Quazar API and in-memory DB.
+
+Run from osysHome root:
+    python -m plugins.YandexDevices.benchmark.run --devices 1000 --output bench.json
+    python -m plugins.YandexDevices.benchmark.run --devices 1000 --compare bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.pool import StaticPool
+
+from plugins.YandexDevices.emulators.quazar import FakeQuazar
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q * (len(values) - 1))))
+    return round(values[index] * 1000, 3)
+
+class Benchmark():
+    def __init__(self, args):
+        self.args = args
+        self.statements = 0
+        self.core_calls = {}
+        self.fake = FakeQuazar(args.devices, args.stations, args.change_rate, args.latency).start()
+        self.cache_dir = tempfile.mkdtemp(prefix='yandexdevices_bench')
+        self._init_db()
+        self._init_plugin()
+
+    def _init_db(self):
+        from app.database import db
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+        db.init_app(self.app)
+        self.app.app_context().push()
+        import plugins.YandexDevices.models.YaDevices  # noqa: F401 register tables
+        import plugins.YandexDevices.models.YaStation  # noqa: F401
+        import plugins.YandexDevices.models.YaCapabilities  # noqa: F401
+        db.create_all()
+        event.listen(db.engine, 'before_cursor_execute', self._count_statement)
+
+    def _count_statement(self, *args):
+        self.statements += 1
+
+    def _core(self, name, result=None):
+        # object system of osysHome is replaced by counters
+        def call(*args, **kwargs):
+            self.core_calls[name] = self.core_calls.get(name, 0) + 1
+            return result
+        return call
+
+    def _init_plugin(self):
+        import plugins.YandexDevices as module
+        app = self.app
+        session_scope = module.session_scope
+
+        @contextmanager
+        def app_session_scope():
+            with app.app_context():
+                with session_scope() as session:
+                    yield session
+
+        module.session_scope = app_session_scope
+        module.getCacheDir = lambda: self.cache_dir
+        for name in ('setProperty', 'updateProperty', 'callMethod', 'setLinkToObject', 'removeLinkFromObject'):
+            setattr(module, name, self._core(name))
+        module.getProperty = self._core('getProperty', 0)
+
+        plugin = module.YandexDevices.__new__(module.YandexDevices)
+        plugin.name = 'YandexDevices'
+        plugin.logger = logging.getLogger('YandexDevicesBenchmark')
+        plugin.event = threading.Event()
+        plugin.sendDataToWebsocket = self._core('sendDataToWebsocket')
+        plugin.saveConfig = lambda: None
+        plugin.config = {
+            'get_device_data': True,
+            'update_linked': False,
+            'poll_workers': self.args.workers,
+            'command_window': self.args.command_window,
+            'read_rate': 100000,
+            'write_rate': 100000,
+        }
+        plugin.initialization()
+        plugin.quazar.hosts = self.fake.hosts
+        self.plugin = plugin
+
+    def measure(self, name, func):
+        self.fake.reset_counts()
+        statements_before = self.statements
+        started = time.monotonic()
+        ops, latencies = func()
+        seconds = time.monotonic() - started
+        result = {
+            'ops': ops,
+            'seconds': round(seconds, 3),
+            'throughput': round(ops / seconds, 1) if seconds else None,
+            'p50_ms': percentile(latencies, 0.5),
+            'p99_ms': percentile(latencies, 0.99),
+            'requests': self.fake.requests,
+            'requests_by_endpoint': dict(self.fake.counts),
+            'db_statements': self.statements - statements_before,
+        }
+        print(f"{name}: {json.dumps({k: v for k, v in result.items() if k != 'requests_by_endpoint'})}", file=sys.stderr)
+        return result
+
+    def wait_idle(self, timeout=600):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.plugin._poll_lock:
+                if not self.plugin._polling:
+                    return
+            time.sleep(0.005)
+
+    def bench_update_devices(self):
+        started = time.monotonic()
+        self.plugin.refresh_stations()
+        self.plugin.update_devices()
+        return len(self.fake.devices), [time.monotonic() - started]
+
+    def bench_poll(self, bulk):
+        plugin = self.plugin
+        plugin.config['bulk_refresh'] = bulk
+        latencies = []
+        refresh_device_data = type(plugin).refresh_device_data
+
+        def timed(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return refresh_device_data(plugin, *args, **kwargs)
+            finally:
+                latencies.append(time.monotonic() - started)
+
+        plugin.refresh_device_data = timed
+        from plugins.YandexDevices.models.YaDevices import YaDevices
+        with plugin_session(plugin) as session:
+            device_ids = [row.id for row in session.query(YaDevices.id).all()]
+        ops = 0
+        for _ in range(self.args.cycles):
+            plugin.scheduler.load([(device_id, 3600, 0) for device_id in device_ids])
+            plugin.refresh_devices_data()
+            self.wait_idle()
+            ops += len(device_ids)
+        del plugin.refresh_device_data
+        return ops, latencies
+
+    def bench_say(self):
+        from plugins.YandexDevices.models.YaStation import YaStation
+        plugin = self.plugin
+        with plugin_session(plugin) as session:
+            for station in session.query(YaStation).all():
+                station.tts = 2
+                station.min_level = '0'
+            session.commit()
+        latencies = []
+        count = self.args.messages
+        for i in range(count):
+            started = time.monotonic()
+            plugin.say(f'Сообщение номер {i}', 1)
+            latencies.append(time.monotonic() - started)
+        # ожидание отправки всех сообщений
+        while any(stats['depth'] or stats['sent'] < count for stats in plugin.tts_queue.stats().values()):
+            time.sleep(0.01)
+        return count, latencies
+
+    def bench_linked(self):
+        from plugins.YandexDevices.models.YaCapabilities import YaCapabilities
+        plugin = self.plugin
+        with plugin_session(plugin) as session:
+            caps = session.query(YaCapabilities).filter(YaCapabilities.title == 'devices.capabilities.on_off').limit(self.args.linked).all()
+            for i, cap in enumerate(caps):
+                cap.linked_object = f'Light{i}'
+                cap.linked_property = 'state'
+            session.commit()
+            linked = len(caps)
+        plugin.load_link_index()
+        latencies = []
+        for n in range(self.args.linked_changes):
+            for i in range(linked):
+                started = time.monotonic()
+                plugin.changeLinkedProperty(f'Light{i}', 'state', n % 2)
+                latencies.append(time.monotonic() - started)
+        time.sleep(plugin.commands.window + 0.5)  # отправка накопленных команд
+        return len(latencies), latencies
+
+    def run(self):
+        results = {
+            'update_devices': self.measure('update_devices', self.bench_update_devices),
+            'poll': self.measure('poll', lambda: self.bench_poll(False)),
+            'poll_bulk': self.measure('poll_bulk', lambda: self.bench_poll(True)),
+            'say': self.measure('say', self.bench_say),
+            'changeLinkedProperty': self.measure('changeLinkedProperty', self.bench_linked),
+        }
+        return {
+            'commit': git_commit(),
+            'time': int(time.time()),
+            'params': vars(self.args),
+            'core_calls': self.core_calls,
+            'results': results,
+        }
+
+@contextmanager
+def plugin_session(plugin):
+    import plugins.YandexDevices as module
+    with module.session_scope() as session:
+        yield session
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new):
+    # relative change of main values, >1 for time/requests means regression
+    for name, result in new['results'].items():
+        base = old.get('results', {}).get(name)
+        if not base:
+            continue
+        line = []
+        for key in ('seconds', 'throughput', 'p50_ms', 'p99_ms', 'requests', 'db_statements'):
+            if base.get(key) and result.get(key) is not None:
+                line.append(f'{key} x{result[key] / base[key]:.2f}')
+        print(f"{name}: {', '.join(line)}")
+
+def main():
+    parser = argparse.ArgumentParser(description='YandexDevices offline benchmark')
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--stations', type=int, default=2)
+    parser.add_argument('--change-rate', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.0, help='emulated API latency, seconds')
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--linked', type=int, default=20)
+    parser.add_argument('--linked-changes', type=int, default=10)
+    parser.add_argument('--command-window', type=int, default=100)
+    parser.add_argument('--output', help='write JSON result to file')
+    parser.add_argument('--compare', help='previous JSON result')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    result = Benchmark(args).run()
+    data = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    else:
+        print(data)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""Local stand-in of iot.quasar.yandex.ru / quasar.yandex.ru endpoints used by plugin.
+
+Serves all hosts on one port, use QuazarApi(hosts=FakeQuazar.hosts).
+Run: python -m emulators.quazar --devices 1000 --change-rate 0.1 --latency 0.05
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CSRF_TOKEN = 'fake-csrf-token'
+
+class FakeQuazar():
+    def __init__(self, devices=100, stations=2, change_rate=0.1, latency=0.0, host='127.0.0.1', port=0, seed=1):
+        self.change_rate = change_rate  # probability of value change on each read
+        self.latency = latency  # seconds per request
+        self.random = random.Random(seed)
+        self.counts = {}  # "METHOD path" -> count
+        self.actions = []  # (iot_id, actions)
+        self.scenarios = {}
+        self._lock = threading.Lock()
+        self.devices = [self._make_device(i) for i in range(devices)]
+        self.devices += [self._make_station(i) for i in range(stations)]
+        self.by_id = {device['id']: device for device in self.devices}
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                fake._handle(self, 'GET')
+
+            def do_POST(self):
+                fake._handle(self, 'POST')
+
+            def do_PUT(self):
+                fake._handle(self, 'PUT')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://{host}:{self.server.server_address[1]}'
+
+    @property
+    def hosts(self):
+        return {
+            'https://iot.quasar.yandex.ru': self.url,
+            'https://quasar.yandex.ru': self.url,
+            'https://yandex.ru': self.url,
+        }
+
+    @property
+    def requests(self):
+        with self._lock:
+            return sum(self.counts.values())
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts = {}
+            self.actions = []
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _make_device(self, i):
+        now = time.time()
+        if i % 2 == 0:
+            return {
+                'id': str(uuid.UUID(int=i + 1)),
+                'name': f'Lamp {i}',
+                'type': 'devices.types.light',
+                'icon_url': '',
+                'room': f'Room {i % 10}',
+                'state': 'online',
+                'capabilities': [
+                    {'type': 'devices.capabilities.on_off', 'state': {'instance': 'on', 'value': False}, 'last_updated': now},
+                    {'type': 'devices.capabilities.range', 'state': {'instance': 'brightness', 'value': 50}, 'last_updated': now},
+                    {'type': 'devices.capabilities.color_setting', 'state': {'instance': 'color', 'value': {'id': 'white'}}, 'last_updated': now},
+                ],
+                'properties': [],
+            }
+        return {
+            'id': str(uuid.UUID(int=i + 1)),
+            'name': f'Sensor {i}',
+            'type': 'devices.types.sensor',
+            'icon_url': '',
+            'room': f'Room {i % 10}',
+            'state': 'online',
+            'capabilities': [],
+            'properties': [
+                {'type': 'devices.properties.float', 'state': {'instance': 'temperature', 'value': 21.5}, 'parameters': {'instance': 'temperature'}, 'last_updated': now},
+                {'type': 'devices.properties.float', 'state': {'instance': 'humidity', 'value': 40.0}, 'parameters': {'instance': 'humidity'}, 'last_updated': now},
+            ],
+        }
+
+    def _make_station(self, i):
+        return {
+            'id': str(uuid.UUID(int=0x10000 + i)),
+            'name': f'Station {i}',
+            'type': 'devices.types.smart_speaker.yandex.station',
+            'icon_url': '',
+            'room': 'Hall',
+            'state': 'online',
+            'quasar_info': {'device_id': f'STATION{i:04d}', 'platform': 'yandexstation'},
+            'capabilities': [],
+            'properties': [],
+        }
+
+    def _mutate(self, device):
+        # random changes of device state
+        now = time.time()
+        for item in device['capabilities'] + device['properties']:
+            if self.random.random() >= self.change_rate:
+                continue
+            state = item['state']
+            if isinstance(state['value'], bool):
+                state['value'] = not state['value']
+            elif isinstance(state['value'], (int, float)):
+                state['value'] = round(state['value'] + self.random.uniform(-1, 1), 1)
+            item['last_updated'] = now
+
+    def _device_state(self, device):
+        with self._lock:
+            self._mutate(device)
+            return json.loads(json.dumps(device))
+
+    def _handle(self, handler, method):
+        if self.latency:
+            time.sleep(self.latency)
+        path = handler.path.split('?')[0]
+        key = f"{method} {re.sub(r'[0-9a-f]{8}-[0-9a-f-]{27}', '{id}', path)}"
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+        body = None
+        length = int(handler.headers.get('Content-Length') or 0)
+        if length:
+            body = json.loads(handler.rfile.read(length) or b'null')
+        if method != 'GET' and handler.headers.get('x-csrf-token') != CSRF_TOKEN:
+            return self._send(handler, 403, {'status': 'error', 'message': 'invalid csrf token'})
+        status, data = self._route(method, path, body)
+        if isinstance(data, str):
+            return self._send(handler, status, data, 'text/html')
+        return self._send(handler, status, data)
+
+    def _route(self, method, path, body):
+        if path == '/quasar/iot':
+            return 200, f'<html><script>window.__PRELOADED_STATE__ = {{"csrfToken2":"{CSRF_TOKEN}"}}</script></html>'
+        if path == '/m/user/devices' and method == 'GET':
+            rooms = {}
+            for device in self.devices:
+                item = {key: device[key] for key in ('id', 'name', 'type', 'icon_url') if key in device}
+                if 'quasar_info' in device:
+                    item['quasar_info'] = device['quasar_info']
+                rooms.setdefault(device['room'], []).append(item)
+            return 200, {'status': 'ok', 'rooms': [{'name': name, 'devices': devices} for name, devices in rooms.items()]}
+        if path == '/m/v3/user/devices' and method == 'GET':
+            return 200, {'status': 'ok', 'households': [{'name': 'Home', 'all': [self._device_state(d) for d in self.devices]}]}
+        match = re.match(r'^/m/user/devices/([^/]+)(/actions)?$', path)
+        if match and match.group(1) in self.by_id:
+            device = self.by_id[match.group(1)]
+            if match.group(2) and method == 'POST':
+                with self._lock:
+                    self.actions.append((device['id'], body.get('actions', [])))
+                return 200, {'status': 'ok', 'devices': [{'id': device['id'], 'capabilities': []}]}
+            if not match.group(2):
+                return 200, dict(self._device_state(device), status='ok')
+        if path == '/devices_online_stats':
+            items = [{
+                'id': d['quasar_info']['device_id'], 'name': d['name'], 'icon': '', 'platform': d['quasar_info']['platform'],
+                'screen_capable': False, 'screen_present': False, 'online': True,
+            } for d in self.devices if 'quasar_info' in d]
+            return 200, {'status': 'ok', 'items': items}
+        if path == '/m/user/scenarios' and method == 'GET':
+            return 200, {'status': 'ok', 'scenarios': [{'id': sid, 'name': s['name']} for sid, s in self.scenarios.items()]}
+        if path == '/m/user/scenarios/' and method == 'POST':
+            scenario_id = str(uuid.uuid4())
+            self.scenarios[scenario_id] = body
+            return 200, {'status': 'ok', 'scenario_id': scenario_id}
+        match = re.match(r'^/m/v4/user/scenarios/([^/]+)$', path)
+        if match and method == 'PUT':
+            self.scenarios[match.group(1)] = body
+            return 200, {'status': 'ok'}
+        if re.match(r'^/m/user/scenarios/([^/]+)/actions$', path) and method == 'POST':
+            return 200, {'status': 'ok'}
+        return 404, {'status': 'error', 'code': 'NOT_FOUND'}
+
+    def _send(self, handler, status, data, content_type='application/json'):
+        payload = (data if isinstance(data, str) else json.dumps(data)).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Quazar API')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--change-rate', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+    fake = FakeQuazar(args.devices, change_rate=args.change_rate, latency=args.latency, port=args.port).start()
+    print(f'Fake Quazar on {fake.url}')
+    try:
+        while True:
+            time.sleep(10)
+            print(fake.counts)
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,81 @@
+"""Local stand-in of Yandex station (glagol protocol) for offline testing.
+
+Run: python -m emulators.station --port 1961 --token TOKEN
+and set station IP to ws://127.0.0.1:1961 in plugin.
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from .ws import WebSocketServer
+
+class FakeStation():
+    def __init__(self, token, host='127.0.0.1', port=0, ssl_context=None, state_interval=1.0):
+        self.token = token
+        self.state_interval = state_interval
+        self.commands = []  # received payloads
+        self.server = WebSocketServer(self._handle, host, port, ssl_context)
+
+    @property
+    def url(self):
+        return self.server.url
+
+    def start(self):
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop()
+
+    def _handle(self, conn):
+        stop = threading.Event()
+        threading.Thread(target=self._push_state, args=(conn, stop), daemon=True).start()
+        try:
+            while True:
+                message = json.loads(conn.recv())
+                response = {
+                    'id': str(uuid.uuid4()),
+                    'requestId': message.get('id'),
+                    'sentTime': int(time.time() * 1000),
+                }
+                if message.get('conversationToken') != self.token:
+                    response['status'] = 'UNAUTHORIZED'
+                    conn.send(json.dumps(response))
+                    conn.close()
+                    return
+                payload = message.get('payload', {})
+                if payload.get('command') != 'ping':
+                    self.commands.append(payload)
+                response['status'] = 'SUCCESS'
+                response['state'] = self._state()
+                conn.send(json.dumps(response))
+        finally:
+            stop.set()
+
+    def _push_state(self, conn, stop):
+        # real station sends own state continuously
+        while not stop.wait(self.state_interval):
+            try:
+                conn.send(json.dumps({'id': str(uuid.uuid4()), 'sentTime': int(time.time() * 1000), 'state': self._state()}))
+            except OSError:
+                return
+
+    def _state(self):
+        return {'aliceState': 'IDLE', 'playing': False, 'volume': 0.5}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Yandex station')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1961)
+    parser.add_argument('--token', default='test')
+    args = parser.parse_args()
+    station = FakeStation(args.token, args.host, args.port).start()
+    print(f'Fake station on {station.url}, token {args.token}')
+    try:
+        while True:
+            time.sleep(1)
+            while station.commands:
+                print(station.commands.pop(0))
+    except KeyboardInterrupt:
+        station.stop()
@@ -0,0 +1,56 @@
+"""Local stand-in of Yandex IoT updates websocket for offline testing.
+
+FakeUpdatesServer().start() then use its url as updates_url and push()
+device states to connected clients.
+"""
+import json
+import time
+from .ws import WebSocketServer
+
+class FakeUpdatesServer():
+    def __init__(self, host='127.0.0.1', port=0, ssl_context=None):
+        self.server = WebSocketServer(self._handle, host, port, ssl_context)
+
+    @property
+    def url(self):
+        return self.server.url
+
+    @property
+    def clients(self):
+        return len(self.server.connections)
+
+    def start(self):
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop()
+
+    def disconnect_all(self):
+        self.server.disconnect_all()
+
+    def push(self, devices):
+        # devices - list of {"id": iot_id, "capabilities": [...], "properties": [...]}
+        message = {
+            'operation': 'update_states',
+            'message': json.dumps({'updated_devices': devices, 'source': 'fake'}),
+        }
+        for conn in list(self.server.connections):
+            try:
+                conn.send(json.dumps(message))
+            except OSError:
+                pass
+
+    def _handle(self, conn):
+        while True:
+            conn.recv()  # client does not send data, only keep connection
+
+if __name__ == '__main__':
+    server = FakeUpdatesServer(port=8765).start()
+    print(f'Fake updates on {server.url}')
+    try:
+        while True:
+            time.sleep(5)
+            server.push([{'id': 'test', 'properties': [{'type': 'devices.properties.float', 'state': {'instance': 'temperature', 'value': round(time.time() % 30, 1)}, 'parameters': {'instance': 'temperature'}}]}])
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,174 @@
+import base64
+import hashlib
+import socket
+import struct
+import threading
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_TEXT = 0x1
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+class WebSocketClosed(Exception):
+    pass
+
+class WebSocketConnection():
+    # Server side of websocket connection (RFC 6455, text frames only)
+    def __init__(self, sock, path):
+        self.sock = sock
+        self.path = path
+        self.closed = False
+        self._send_lock = threading.Lock()
+
+    def recv(self):
+        while True:
+            opcode, data = self._read_frame()
+            if opcode == OP_TEXT:
+                return data.decode('utf-8')
+            if opcode == OP_PING:
+                self._write_frame(OP_PONG, data)
+            elif opcode == OP_CLOSE:
+                self.close()
+                raise WebSocketClosed()
+
+    def send(self, text):
+        self._write_frame(OP_TEXT, text.encode('utf-8'))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._write_frame(OP_CLOSE, b'')
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _read_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                self.closed = True
+                raise WebSocketClosed()
+            data += chunk
+        return data
+
+    def _read_frame(self):
+        head1, head2 = self._read_exact(2)
+        opcode = head1 & 0x0F
+        length = head2 & 0x7F
+        if length == 126:
+            length = struct.unpack('>H', self._read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack('>Q', self._read_exact(8))[0]
+        mask = self._read_exact(4) if head2 & 0x80 else None
+        data = self._read_exact(length)
+        if mask:
+            data = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+        return opcode, data
+
+    def _write_frame(self, opcode, data):
+        header = bytes([0x80 | opcode])
+        length = len(data)
+        if length < 126:
+            header += bytes([length])
+        elif length < 65536:
+            header += bytes([126]) + struct.pack('>H', length)
+        else:
+            header += bytes([127]) + struct.pack('>Q', length)
+        with self._send_lock:
+            self.sock.sendall(header + data)
+
+class WebSocketServer():
+    # Minimal threaded websocket server for emulators, handler(connection) per client
+    def __init__(self, handler, host='127.0.0.1', port=0, ssl_context=None):
+        self.handler = handler
+        self.ssl_context = ssl_context
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(16)
+        self.host, self.port = self.sock.getsockname()
+        self.connections = set()
+        self._running = False
+
+    @property
+    def url(self):
+        scheme = 'wss' if self.ssl_context else 'ws'
+        return f'{scheme}://{self.host}:{self.port}'
+
+    def start(self):
+        self._running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self.sock.close()
+        for conn in list(self.connections):
+            conn.close()
+
+    def disconnect_all(self):
+        # drop clients (reconnect testing)
+        for conn in list(self.connections):
+            conn.closed = True
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.sock.close()
+
+    def _accept(self):
+        while self._running:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        try:
+            if self.ssl_context:
+                client = self.ssl_context.wrap_socket(client, server_side=True)
+            conn = self._handshake(client)
+        except (OSError, ValueError):
+            client.close()
+            return
+        self.connections.add(conn)
+        try:
+            self.handler(conn)
+        except (WebSocketClosed, OSError):
+            pass
+        finally:
+            self.connections.discard(conn)
+            conn.close()
+
+    def _handshake(self, client):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            chunk = client.recv(4096)
+            if not chunk:
+                raise ValueError('Connection closed during handshake')
+            request += chunk
+        lines = request.decode('latin-1').split('\r\n')
+        path = lines[0].split(' ')[1]
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        key = headers.get('sec-websocket-key')
+        if not key:
+            raise ValueError('Not websocket request')
+        accept = base64.b64encode(hashlib.sha1((key + GUID).encode()).digest()).decode()
+        response = (
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Accept: {accept}\r\n\r\n'
+        )
+        client.sendall(response.encode())
+        return WebSocketConnection(client, path)
@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, IntegerField, BooleanField
+from wtforms import StringField, SubmitField, IntegerField, BooleanField, FloatField
 from wtforms.validators import DataRequired, Optional
 from wtforms.widgets import PasswordInput
 
@@ -8,4 +8,17 @@ class SettingsForm(FlaskForm):
     get_data = BooleanField('Enable get device data', validators=[Optional()])
     update_period = IntegerField('Default update period device data (seconds)', validators=[Optional()])
     update_linked = BooleanField('Update only linked devices', validators=[Optional()])
+    updates_stream = BooleanField('Get device updates from stream (polling only for check)', validators=[Optional()])
+    deadband = FloatField('Ignore sensor changes less than', validators=[Optional()])
+    bulk_refresh = BooleanField('Get data of all devices by one request', validators=[Optional()])
+    poll_workers = IntegerField('Count threads for get device data (restart required)', validators=[Optional()])
+    request_timeout = IntegerField('Request timeout (seconds)', validators=[Optional()])
+    command_window = IntegerField('Window for merge device commands (ms)', validators=[Optional()])
+    read_rate = IntegerField('Max read requests per second (restart required)', validators=[Optional()])
+    write_rate = IntegerField('Max write requests per second (restart required)', validators=[Optional()])
+    ui_interval = IntegerField('Min interval of updates in web interface (ms)', validators=[Optional()])
+    history_days = IntegerField('Keep full history of values (days), older values are aggregated', validators=[Optional()])
+    async_engine = BooleanField('Use asyncio engine for requests, aiohttp required (restart required)', validators=[Optional()])
+    accounts = StringField('Additional Yandex accounts, comma separated (restart required)', validators=[Optional()])
+    pool_size = IntegerField('HTTP connection pool size (restart required)', validators=[Optional()])
     submit = SubmitField('Submit')
\ No newline at end of file
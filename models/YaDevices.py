@@ -7,5 +7,6 @@ class YaDevices(SurrogatePK, db.Model):
     room = Column(db.String(100))
     icon = Column(db.Text)
     iot_id = Column(db.String(255))
+    account = Column(db.String(100))  # Yandex account, empty - main
     update_period = Column(db.Integer())
     updated = Column(db.DateTime) 
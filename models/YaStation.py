@@ -9,6 +9,7 @@ class YaStation(SurrogatePK, db.Model):
     min_level = Column(db.String(100))
     station_id = Column(db.String(255))
     iot_id = Column(db.String(255))
+    account = Column(db.String(100))  # Yandex account, empty - main
     device_token = Column(db.String(255))
     screen_capable = Column(db.Integer())
     screen_present = Column(db.Integer())